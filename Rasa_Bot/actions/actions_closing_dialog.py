@@ -1,4 +1,5 @@
 import datetime
+import numpy as np
 
 from niceday_client import NicedayClient
 from rasa_sdk import Action, Tracker
@@ -15,7 +16,7 @@ from virtual_coach_db.helper.definitions import (Components,
 from .definitions import NICEDAY_API_ENDPOINT, PAUSE_AND_TRIGGER, REDIS_URL
 from .helper import (get_latest_bot_utterance, get_smoked_cigarettes_range,
                      store_pf_evaluation_to_db, get_faik_text)
-from sensorapi.connector import get_steps_data
+from sensorapi.connector import get_steps_arrays
 
 
 celery = Celery(broker=REDIS_URL)
@@ -292,11 +293,9 @@ class ActionClosingGetTotalNumberSteps(Action):
         # Get sender ID from slot, this is a string
         user_id = tracker.current_state()['sender_id']
         # Get all steps stored
-        steps_data = get_steps_data(user_id)
+        _, steps = get_steps_arrays(user_id)
         # Sum all data
-        if not steps_data:
-            return [SlotSet('closing_total_steps_number', 0)]
-        total_steps = sum(day['steps'] for day in steps_data)
+        total_steps = int(steps.sum(dtype=np.int64))
 
         return [SlotSet('closing_total_steps_number', total_steps)]
 
@@ -30,7 +30,7 @@ from .helper import (get_intensity_minutes_goal,
                      store_dialog_part_to_db,
                      mark_completion)
 from virtual_coach_db.helper.definitions import Components
-from sensorapi.connector import get_steps_data, get_step_goals_and_steps, get_intensity_minutes_data
+from sensorapi.connector import get_steps_data, get_weekly_step_goals, get_intensity_minutes_data
 
 
 celery = Celery(broker=REDIS_URL)
@@ -263,11 +263,7 @@ class SetStepGoalDays(Action):
     async def run(self, dispatcher, tracker, domain):
         user_id = int(tracker.current_state()['sender_id'])
 
-        end = datetime.datetime.now()
-        start = end - datetime.timedelta(days=16)
-        steps_data = get_steps_data(user_id=user_id, start_date=start, end_date=end)
-
-        _, _, _, step_goal_days = get_step_goals_and_steps(steps_data, start, end)
+        _, _, _, step_goal_days = get_weekly_step_goals(user_id)
 
         if step_goal_days is None:
             dispatcher.utter_message(response="Er is iets mis met de data. Contact de onderzoeker:"
@@ -398,12 +394,9 @@ class ShowPaOverview(Action):
     async def run(self, dispatcher, tracker, domain):
         # Get data from API
         user_id = int(tracker.current_state()['sender_id'])
-        end = datetime.datetime.now()
-        start = end - datetime.timedelta(days=16)
-        steps_data = get_steps_data(user_id=user_id, start_date=start, end_date=end)
 
         # Get steps, goals and dates
-        step_goal, step_array, date_array, _ = get_step_goals_and_steps(steps_data, start, end)
+        step_goal, step_array, date_array, _ = get_weekly_step_goals(user_id)
 
         if date_array is None:
             logging.error(f'user id: {user_id}, dialog: weekly reflection,'
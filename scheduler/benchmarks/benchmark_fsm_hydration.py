@@ -0,0 +1,138 @@
+"""
+Benchmark of the loading of all the users' state machines, comparing the single joined query
+of get_all_fsm with the loading of each state machine with get_user_fsm (1 + 2N queries).
+
+Example, from the scheduler folder, with DATABASE_URL pointing to a scratch database:
+    python -m benchmarks.benchmark_fsm_hydration --users 500 5000 50000
+
+The synthetic users get IDs from FIRST_USER_ID, and are removed at the end of each run.
+"""
+import argparse
+import time
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from celery_utils import STATES, get_all_fsm, get_all_fsm_from_db, get_user_fsm
+from state_machine.const import TIMEZONE
+from state_machine.state import State
+from state_machine.state_machine import StateMachine
+from virtual_coach_db.dbschema.models import InterventionComponents, Users, UserStateMachine
+from virtual_coach_db.helper.helper_functions import get_db_session
+
+FIRST_USER_ID = 900_000_000
+
+
+class QueryCounter:
+    """
+    Counts the queries sent to the DB by all the engines
+    """
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self.on_query)
+
+    def on_query(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self.count += 1
+
+
+def create_users(num_users: int):
+    """
+    Create the synthetic users and their state machines, spread over all the states
+    (except the completed one) and all the intervention components.
+    """
+    session = get_db_session()
+
+    component_ids = [component.intervention_component_id
+                     for component in session.query(InterventionComponents).all()]
+    states = [state for state in STATES if state != State.COMPLETED]
+    now = datetime.now().astimezone(TIMEZONE)
+
+    session.bulk_save_objects([Users(nicedayuid=FIRST_USER_ID + i, start_date=now.date())
+                               for i in range(num_users)])
+    session.bulk_save_objects([
+        UserStateMachine(users_nicedayuid=FIRST_USER_ID + i,
+                         state=states[i % len(states)],
+                         dialog_running=i % 2 == 0,
+                         dialog_start_time=now,
+                         intervention_component_id=component_ids[i % len(component_ids)])
+        for i in range(num_users)])
+    session.commit()
+
+    session.close()
+
+
+def delete_users():
+    session = get_db_session()
+
+    (session.query(UserStateMachine)
+     .filter(UserStateMachine.users_nicedayuid >= FIRST_USER_ID)
+     .delete(synchronize_session=False))
+    (session.query(Users)
+     .filter(Users.nicedayuid >= FIRST_USER_ID)
+     .delete(synchronize_session=False))
+    session.commit()
+
+    session.close()
+
+
+def get_all_fsm_per_user() -> List[StateMachine]:
+    """
+    Load the state machines one by one, as done before the joined query was introduced
+    """
+    return [get_user_fsm(fsm.users_nicedayuid) for fsm in get_all_fsm_from_db()]
+
+
+def measure(loader: Callable[[], List[StateMachine]],
+            counter: QueryCounter) -> Tuple[List[StateMachine], float, int]:
+    queries = counter.count
+    start = time.perf_counter()
+    state_machines = loader()
+
+    return state_machines, time.perf_counter() - start, counter.count - queries
+
+
+def summary(state_machines: List[StateMachine]) -> List[Tuple]:
+    return sorted((fsm.machine_id, fsm.state.__state__(),
+                   fsm.dialog_state.get_running_status(),
+                   fsm.dialog_state.get_current_dialog())
+                  for fsm in state_machines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the state machines loading')
+    parser.add_argument('--users', type=int, nargs='+', default=[500, 5000, 50000],
+                        help='numbers of synthetic users')
+    parser.add_argument('--max-per-user', type=int, default=5000,
+                        help='maximum number of users for which the per-user loading is run')
+    args = parser.parse_args()
+
+    counter = QueryCounter()
+
+    print(f"{'users':>8}{'loader':>12}{'machines':>10}{'queries':>10}{'seconds':>10}")
+    for num_users in args.users:
+        delete_users()
+        create_users(num_users)
+
+        try:
+            loaders = {'joined': get_all_fsm}
+            if num_users <= args.max_per_user:
+                loaders['per user'] = get_all_fsm_per_user
+
+            results = {}
+            for name, loader in loaders.items():
+                state_machines, seconds, queries = measure(loader, counter)
+                results[name] = summary(state_machines)
+                print(f'{num_users:>8}{name:>12}{len(state_machines):>10}'
+                      f'{queries:>10}{seconds:>10.2f}')
+
+            if 'per user' in results and results['joined'] != results['per user']:
+                print('The state machines loaded by the two methods differ')
+        finally:
+            delete_users()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,9 @@ import logging
 import time
 
 import requests
-from celery import Celery
+from celery import Celery, chord, group, signals
 from celery.schedules import crontab
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 from django.conf import settings
@@ -11,16 +12,30 @@ from django.core.cache import cache
 from state_machine.state import State
 from state_machine.state_machine import EventEnum, Event
 from state_machine.const import (REDIS_URL, TIMEZONE, MAXIMUM_DIALOG_DURATION, NICEDAY_API_ENDPOINT,
-                                 RUNNING, EXPIRED, NOTIFY, INVITES_CHECK_INTERVAL,
-                                 MAXIMUM_INACTIVE_DAYS, MORNING_TIME, WORDS_PER_SECOND, MAX_DELAY)
-from typing import Optional
-from celery_utils import (check_if_physical_relapse, check_if_task_executed, check_if_user_active,
-                          check_if_user_exists, create_new_user, get_component_name, get_user_fsm,
-                          get_dialog_state, get_all_fsm, get_intervention_component_by_id,
-                          get_scheduled_task_from_db, save_state_machine_to_db, send_fsm_event,
-                          set_dialog_running_status, update_scheduled_task_db, update_task_uuid_db)
+                                 RUNNING, INVITES_CHECK_INTERVAL, INVITES_ACCEPT_WORKERS,
+                                 MAXIMUM_INACTIVE_DAYS, MORNING_TIME, WORDS_PER_SECOND, MAX_DELAY,
+                                 STEP_GOALS_TIME, STEP_GOALS_MAX_RETRIES,
+                                 NEW_DAY_CHUNK_SIZE, NEW_DAY_MAX_RETRIES,
+                                 NEW_DAY_MARKER_EXPIRE, NEW_DAY_SENDING_EXPIRE,
+                                 TIMER_POLL_INTERVAL, TIMER_LEASE, TIMER_BATCH_SIZE,
+                                 TELEMETRY_LOG_INTERVAL, RASA_URL, RASA_TIMEOUT)
+from typing import Any, Dict, List, Optional
+from state_machine.state_machine_utils import (claim_due_tasks, get_catalog,
+                                               get_scheduled_task_ids, remove_scheduled_task,
+                                               schedule_trigger)
+from celery_utils import (check_if_task_executed, create_new_users, delete_new_users,
+                          get_existing_user_ids, get_component_name, get_user_fsm,
+                          get_dialog_state, get_all_fsm, get_all_fsm_from_db,
+                          get_last_completion_times, get_overdue_dialogs,
+                          get_journaled_user_ids, get_physical_relapse_users,
+                          get_scheduled_task_triggers_from_db, replay_fsm_journal,
+                          save_state_machine_to_db, send_fsm_event, set_dialog_running_status,
+                          set_expired_dialogs_to_idle, update_scheduled_task_db,
+                          update_task_uuids_db, user_fsm_lock)
 from virtual_coach_db.helper.definitions import (NotificationsTriggers, ComponentsTriggers,
                                                  Components)
+from sensorapi.connector import store_step_goals
+from telemetry import log_summary
 
 
 from niceday_client import NicedayClient
@@ -28,11 +43,20 @@ from niceday_client import NicedayClient
 app = Celery('celery_tasks', broker=REDIS_URL)
 app.conf.enable_utc = True
 app.conf.timezone = TIMEZONE
-# 1 month visibility. Temporary fix
+# 1 month visibility. Temporary fix. The scheduled intervention components are now planned
+# in the timer (see release_due_tasks), so this is only needed until the tasks sent with
+# an ETA before the timer was introduced have been executed
 app.conf.broker_transport_options = {'visibility_timeout': 2678400}
+# the results are stored only for the tasks that need them (e.g., the chords' headers)
+app.conf.result_backend = REDIS_URL
+app.conf.task_ignore_result = True
 
 client = NicedayClient(niceday_api_uri=NICEDAY_API_ENDPOINT)
 
+# keep-alive connections to rasa_server, reused by all the tasks of a worker process.
+# The requests are sent only by the pool processes, so no connection is shared across a fork
+rasa_session = requests.Session()
+
 # Django configuration for cache memory usage
 CACHES = {
     "default": {
@@ -55,6 +79,19 @@ def memcache_lock(lock_id, oid):
             cache.delete(lock_id)
 
 
+@signals.worker_process_init.connect
+def load_intervention_catalog(**kwargs):  # pylint: disable=unused-argument
+    """
+    When a worker process starts, the catalog of the intervention components and phases is
+    loaded, so that the tasks do not query the static tables. If the DB is not reachable,
+    the catalog is loaded at the first use.
+    """
+    try:
+        get_catalog()
+    except Exception as error:  # pylint: disable=broad-except
+        logging.warning(f'Intervention catalog not loaded: {error}')
+
+
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):  # pylint: disable=unused-argument
     """
@@ -67,38 +104,98 @@ def setup_periodic_tasks(sender, **kwargs):  # pylint: disable=unused-argument
     sender.add_periodic_task(crontab(hour=10, minute=00), check_inactivity.s())
     # check if the user is in physical relapse
     sender.add_periodic_task(crontab(hour=10, minute=00), check_physical_relapse.s())
+    # precompute the step goals of the day for all the users
+    sender.add_periodic_task(crontab(hour=STEP_GOALS_TIME, minute=00), precompute_step_goals.s())
     # check if a dialog has been completed
     sender.add_periodic_task(MAXIMUM_DIALOG_DURATION, check_dialogs_status.s())
     # check if new connections are pending and, in case, accept them
     sender.add_periodic_task(INVITES_CHECK_INTERVAL, check_new_connection_request.s())
+    # release the scheduled intervention components that are due
+    sender.add_periodic_task(TIMER_POLL_INTERVAL, release_due_tasks.s())
+    # log the summary of the tasks telemetry
+    sender.add_periodic_task(TELEMETRY_LOG_INTERVAL, log_task_telemetry.s())
     # check if there are tasks pending and cancelled from the scheduler queue
     restore_scheduled_tasks.apply_async(eta=datetime.now() + timedelta(minutes=1))
 
 
 @app.task
 def restore_scheduled_tasks():
+    """
+    This task re-schedules the tasks planned in the DB that are no more planned in the timer
+    (e.g., after a restart of redis without persistence).
+    """
     # get all the already scheduled tasks
-    scheduled_task = app.control.inspect().scheduled()
-    tasks_list = [task['request']['id']
-                  for workers in scheduled_task
-                  for task in scheduled_task[workers]]
+    tasks_list = get_scheduled_task_ids()
 
     # get all the tasks scheduled in the DB
-    db_tasks = get_scheduled_task_from_db()
+    db_tasks = get_scheduled_task_triggers_from_db()
 
     # restore the tasks that were scheduled in the DB but are no more in the tasks list
-    for db_task in db_tasks:
-        # if the tasks saved in the DB is not in the list of the scheduled tasks
-        if db_task.task_uuid not in tasks_list:
-            # reschedule the task
-            component = get_intervention_component_by_id(db_task.intervention_component_id)
-            new_task = trigger_scheduled_intervention_component.apply_async(
-                args=[db_task.users_nicedayuid,
-                      component.intervention_component_trigger],
-                eta=db_task.next_planned_date.astimezone(TIMEZONE))
+    new_uuids = {}
+    for task_uuid, user_id, trigger, planned_date in db_tasks:
+        if task_uuid in tasks_list:
+            continue
+
+        # reschedule the task
+        new_uuids[task_uuid] = schedule_trigger(user_id, trigger,
+                                                planned_date.astimezone(TIMEZONE))
+
+    # update the uuids in the DB
+    update_task_uuids_db(new_uuids)
+
+    if new_uuids:
+        logging.info(f'Restored {len(new_uuids)} scheduled tasks')
+
+
+@app.task
+def release_due_tasks():
+    """
+    This task sends the scheduled intervention components whose planned time has been reached.
+    Each task is released with the uuid it was planned with, which is the one stored in the DB.
+    """
+    # the tasks are claimed atomically, so concurrent runs do not release them twice
+    while True:
+        tasks = claim_due_tasks(lease=TIMER_LEASE, limit=TIMER_BATCH_SIZE)
+
+        for task_uuid, user_id, trigger in tasks:
+            # the tasks scheduled in celery with an ETA are executed by the workers
+            if user_id is not None:
+                trigger_scheduled_intervention_component.apply_async(args=[user_id, trigger],
+                                                                     task_id=task_uuid)
+            remove_scheduled_task(task_uuid)
+
+        if len(tasks) < TIMER_BATCH_SIZE:
+            break
+
+
+@app.task
+def log_task_telemetry():
+    """
+    This task logs the number of runs, the run and queue times, the retries and the
+    failures of each task since the worker started
+    """
+    log_summary()
+
+
+@app.task
+def rebuild_state_machines(user_ids: Optional[List[int]] = None):
+    """
+    This task rebuilds the state machines of the users from the journal of their events, and
+    saves them to the DB (e.g., to recover from an incident). It is meant to be run manually,
+    while no events are being processed.
+    Args:
+        user_ids: the IDs of the users. If None, all the users with a journal are rebuilt
+    """
+    if user_ids is None:
+        user_ids = get_journaled_user_ids()
+
+    state_machines = replay_fsm_journal(user_ids)
 
-            # update the uuid in the DB
-            update_task_uuid_db(old_uuid=db_task.task_uuid, new_uuid=str(new_task.task_id))
+    for user_id, state_machine in state_machines.items():
+        with user_fsm_lock(user_id) as lock:
+            save_state_machine_to_db(state_machine, lock)
+
+    logging.info(f'Rebuilt {len(state_machines)} of {len(user_ids)} state machines')
 
 
 @app.task
@@ -110,22 +207,51 @@ def check_physical_relapse():
 
     range_start = datetime.now()
 
-    state_machines = get_all_fsm()
+    state_machines = {fsm.machine_id: fsm for fsm in get_all_fsm()
+                      if fsm.state.__state__() == State.EXECUTION_RUN}
+
+    # the relapse is evaluated for all the users first, and then the dialogs are triggered
+    relapse_users = get_physical_relapse_users(list(state_machines), range_start)
+
+    for user_id in relapse_users:
+        current_dialog_state = get_dialog_state(state_machines[user_id])
+        if current_dialog_state == RUNNING:
+            new_time = datetime.now() + timedelta(seconds=MAXIMUM_DIALOG_DURATION)
+            reschedule_dialog.apply_async(
+                args=[user_id, Components.RELAPSE_DIALOG_SYSTEM, new_time])
+
+        trigger_intervention_component.apply_async(
+            args=[user_id, ComponentsTriggers.RELAPSE_DIALOG_SYSTEM])
+
+
+@app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True,
+          max_retries=STEP_GOALS_MAX_RETRIES)
+def precompute_step_goals(self, user_ids: Optional[List[int]] = None, day: Optional[str] = None):
+    """
+    This task computes the daily step goal, the step goals of the last week and the number of
+    days that they were achieved for all the users in the intervention, so that the dialogs
+    do not have to compute them when requested. Only the users whose steps data could not
+    be retrieved are retried.
+    Args:
+        user_ids: the IDs of the users. If None, all the users in the intervention
+        day: the day the goals are computed for, in ISO format. If None, uses the current date
+    """
+    if user_ids is None:
+        user_ids = [fsm.users_nicedayuid for fsm in get_all_fsm_from_db()]
+
+    current_date = date.fromisoformat(day) if day is not None else date.today()
 
-    for fsm in state_machines:
-        user_id = fsm.machine_id
-        if fsm.dialog_state == State.EXECUTION_RUN:
-            relapse = check_if_physical_relapse(user_id, range_start)
+    stored, failed = store_step_goals(user_ids, current_date)
 
-            if relapse:
-                current_dialog_state = get_dialog_state(fsm)
-                if current_dialog_state == RUNNING:
-                    new_time = datetime.now() + timedelta(seconds=MAXIMUM_DIALOG_DURATION)
-                    reschedule_dialog.apply_async(
-                        args=[user_id, Components.RELAPSE_DIALOG_SYSTEM, new_time])
+    logging.info(f"Step goals precomputed for {stored} of {len(user_ids)} users")
 
-                trigger_intervention_component.apply_async(
-                    args=[user_id, ComponentsTriggers.RELAPSE_DIALOG_SYSTEM])
+    if failed and self.request.retries < self.max_retries:
+        logging.warning(f"Steps data of {len(failed)} users not available, retrying them")
+        raise self.retry(args=[failed, current_date.isoformat()],
+                         countdown=5 * 60 * 2 ** self.request.retries)
+
+    if failed:
+        logging.error(f"Step goals not precomputed for the users {failed}")
 
 
 @app.task(bind=True)
@@ -140,18 +266,56 @@ def check_new_connection_request(self):
         if acquired:
             logging.info('checking new connections')
 
-            pending_requests = client.get_invitation_requests()
+            pending_requests = {request['id']: request
+                                for request in client.get_invitation_requests()}
+
+            # the requests are accepted only if the users are not yet registered.
+            # The users will be disconnected from the VC at the end of the intervention, and
+            # it should not be possible to re-connect
+            existing_users = get_existing_user_ids(list(pending_requests))
+            new_requests = [request for user_id, request in pending_requests.items()
+                            if user_id not in existing_users]
+
+            if not new_requests:
+                return
+
+            # the users are created before accepting their invitations, so that an accepted
+            # user is never missing from the DB
+            created = set(create_new_users([request['id'] for request in new_requests]))
+            to_accept = [request for request in new_requests if request['id'] in created]
+
+            with ThreadPoolExecutor(max_workers=INVITES_ACCEPT_WORKERS) as executor:
+                results = list(executor.map(accept_invitation, to_accept))
+
+            new_users = [request['id'] for request, accepted in zip(to_accept, results)
+                         if accepted]
 
-            for request in pending_requests:
-                user_id = request['id']
-                user_exists = check_if_user_exists(user_id)
-                # the request is accepted only if the user is not yet registered.
-                # The users will be disconnected from the VC at the end of the intervention, and
-                # it should not be possible to re-connect
-                if not user_exists:
-                    client.accept_invitation_request(str(request['invitationId']))
-                    create_new_user(user_id)
-                    start_user_intervention(user_id)
+            # the users whose invitation has not been accepted are removed, so that the
+            # invitation is accepted again at the next check
+            delete_new_users([request['id'] for request, accepted in zip(to_accept, results)
+                              if not accepted])
+
+            group(start_user_intervention.s(user_id) for user_id in new_users).apply_async()
+
+            logging.info(f'Accepted {len(new_users)} of {len(new_requests)} new connections')
+
+
+def accept_invitation(request: Dict[str, Any]) -> bool:
+    """
+    Accept a pending invitation request in Niceday.
+    Args:
+        request: the invitation request, as returned by the Niceday client
+
+    Returns: True if the request has been accepted, False otherwise
+
+    """
+    try:
+        client.accept_invitation_request(str(request['invitationId']))
+    except Exception as error:  # pylint: disable=broad-except
+        logging.warning(f"Invitation of the user {request['id']} not accepted: {error}")
+        return False
+
+    return True
 
 
 @app.task(bind=True)
@@ -169,24 +333,23 @@ def check_dialogs_status(self):  # pylint: disable=unused-argument
 
     logging.info("Checking the dialogs status")
 
-    state_machines = get_all_fsm()
-
-    for fsm in state_machines:
-        dialog_state = get_dialog_state(fsm)
-        dialog = fsm.dialog_state.get_current_dialog()
-        logging.info(f"User {fsm.machine_id} current dialog state {dialog_state}")
+    # only the users to be notified or with an expired dialog are retrieved
+    notify_users, expired_dialogs = get_overdue_dialogs()
 
-        if dialog_state == NOTIFY:
-            trigger_intent.apply_async(args=[fsm.machine_id,
-                                             NotificationsTriggers.FINISH_DIALOG_NOTIFICATION])
+    logging.info(f"{len(notify_users)} dialogs to be notified, "
+                 f"{len(expired_dialogs)} dialogs expired")
 
-        if dialog_state == EXPIRED:
+    for user_id in notify_users:
+        trigger_intent.apply_async(args=[user_id,
+                                         NotificationsTriggers.FINISH_DIALOG_NOTIFICATION])
 
-            # the dialog is idle now
-            fsm.dialog_state.set_to_idle()
-            save_state_machine_to_db(fsm)
+    # the expired dialogs are idle now. The dialogs completed or restarted after they have
+    # been retrieved are not updated, and their users do not receive the expiration event
+    expired_users = set(set_expired_dialogs_to_idle([user_id for user_id, _ in expired_dialogs]))
 
-            send_fsm_event(user_id=fsm.machine_id,
+    for user_id, dialog in expired_dialogs:
+        if user_id in expired_users:
+            send_fsm_event(user_id=user_id,
                            event=Event(EventEnum.DIALOG_EXPIRED, dialog))
 
 
@@ -199,13 +362,20 @@ def check_inactivity():
     """
     current_date = date.today()
     state_machines = get_all_fsm()
-    for item in state_machines:
-        if not check_if_user_active(item.machine_id, current_date, MAXIMUM_INACTIVE_DAYS):
-            current_dialog_state = get_dialog_state(item)
-            if current_dialog_state == RUNNING:
-                return
-            trigger_intent.apply_async(args=[item.machine_id,
-                                             NotificationsTriggers.INACTIVE_USER_NOTIFICATION])
+
+    # users who completed a dialog in the past days
+    active_users = get_last_completion_times(current_date, MAXIMUM_INACTIVE_DAYS)
+
+    # the users running a dialog are not notified
+    inactive_users = [item.machine_id for item in state_machines
+                      if item.machine_id not in active_users
+                      and get_dialog_state(item) != RUNNING]
+
+    logging.info(f"{len(inactive_users)} inactive users notified")
+
+    if inactive_users:
+        group(trigger_intent.s(user_id, NotificationsTriggers.INACTIVE_USER_NOTIFICATION)
+              for user_id in inactive_users).apply_async()
 
 
 @app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True)
@@ -227,16 +397,102 @@ def intervention_component_completed(self,  # pylint: disable=unused-argument
 @app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True)
 def notify_new_day(self, current_date: Optional[date] = None):  # pylint: disable=unused-argument
     """
-    This task notifies all the state machines that a day has begun.
+    This task notifies all the state machines that a day has begun. The users are split
+    in chunks of NEW_DAY_CHUNK_SIZE, which are notified in parallel by the workers, so that
+    the parallelism is bounded by the workers' concurrency. When all the chunks are
+    completed, a report of the sweep is logged.
     Args:
         current_date: the date to be sent to the state machines. If None, uses the current date
     """
     if current_date is None:
         current_date = date.today()
+    elif isinstance(current_date, str):
+        current_date = date.fromisoformat(current_date[:10])
 
-    state_machines = get_all_fsm()
-    for item in state_machines:
-        send_fsm_event(user_id=item.machine_id, event=Event(EventEnum.NEW_DAY, current_date))
+    day = current_date.isoformat()
+    started_at = time.time()
+
+    user_ids = [fsm.users_nicedayuid for fsm in get_all_fsm_from_db()]
+    chunks = [user_ids[i:i + NEW_DAY_CHUNK_SIZE]
+              for i in range(0, len(user_ids), NEW_DAY_CHUNK_SIZE)]
+
+    if not chunks:
+        report_new_day.delay([], day, started_at)
+        return
+
+    chord(notify_new_day_chunk.s(chunk, day) for chunk in chunks)(
+        report_new_day.s(day, started_at))
+
+
+@app.task(bind=True, ignore_result=False, max_retries=NEW_DAY_MAX_RETRIES)
+def notify_new_day_chunk(self,
+                         user_ids: List[int],
+                         day: str,
+                         report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    This task notifies the state machines of a chunk of users that a day has begun.
+    Each user is notified at most once per day, so that the users already notified are
+    skipped if the sweep is repeated. Only the users whose notification failed are retried.
+    Args:
+        user_ids: the IDs of the users to be notified
+        day: the date to be sent to the state machines, in ISO format
+        report: the report of the previous attempts, in case of retry
+
+    Returns: the number of users notified and skipped, and the list of users that failed
+    """
+    current_date = date.fromisoformat(day)
+
+    if report is None:
+        report = {'notified': 0, 'skipped': 0, 'failed': []}
+
+    failed = []
+
+    for user_id in user_ids:
+        marker = f'new_day_{day}_{user_id}'
+
+        # the marker is set while the event is sent, and kept once it has been sent
+        if not cache.add(marker, 'sending', NEW_DAY_SENDING_EXPIRE):
+            report['skipped'] += 1
+            continue
+
+        try:
+            send_fsm_event(user_id=user_id, event=Event(EventEnum.NEW_DAY, current_date))
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(f"New day notification failed for user {user_id}")
+            cache.delete(marker)
+            failed.append(user_id)
+            continue
+
+        cache.set(marker, 'sent', NEW_DAY_MARKER_EXPIRE)
+        report['notified'] += 1
+
+    if failed and self.request.retries < self.max_retries:
+        raise self.retry(args=[failed, day, report], countdown=60 * 2 ** self.request.retries)
+
+    report['failed'].extend(failed)
+
+    return report
+
+
+@app.task
+def report_new_day(chunk_reports: List[Dict[str, Any]], day: str, started_at: float):
+    """
+    This task logs the report of the new day notification, once all the chunks are completed.
+    Args:
+        chunk_reports: the reports of the chunks
+        day: the date sent to the state machines
+        started_at: the time when the notification started
+    """
+    notified = sum(report['notified'] for report in chunk_reports)
+    skipped = sum(report['skipped'] for report in chunk_reports)
+    failed = [user_id for report in chunk_reports for user_id in report['failed']]
+    duration = time.time() - started_at
+
+    logging.info(f"New day {day} sent to {notified} users in {duration:.1f} seconds, "
+                 f"{skipped} already notified, {len(failed)} failed")
+
+    if failed:
+        logging.error(f"New day {day} not sent to the users {failed}")
 
 
 @app.task(autoretry_for=(Exception,), retry_backoff=True)
@@ -254,7 +510,7 @@ def reschedule_dialog(user_id: int, intervention_component_name: str, new_date:
     # check if the scheduled time is in the night (i.e., after midnight and before 6)
     # In case it is, reschedule for the morning.
     if 0 <= new_date.hour <= MORNING_TIME:
-        new_date.replace(hour=8)
+        new_date = new_date.replace(hour=8, minute=0, second=0)
 
     send_fsm_event(user_id=user_id,
                    event=Event(EventEnum.DIALOG_RESCHEDULED_USER,
@@ -322,7 +578,7 @@ def trigger_scheduled_intervention_component(self,
     # In case it is, reschedule for the morning.
     current_date = datetime.now(tz=TIMEZONE)
     if 0 <= current_date.hour <= 7:
-        current_date.replace(hour=8)
+        current_date = current_date.replace(hour=8, minute=0, second=0)
         send_fsm_event(user_id,
                        event=Event(EventEnum.DIALOG_RESCHEDULED_AUTO, (name, current_date)))
 
@@ -393,12 +649,7 @@ def pause_conversation(self,  # pylint: disable=unused-argument
     Args:
         user_id: the ID of the user to send the trigger to
     """
-    endpoint = f'http://rasa_server:5005/conversations/{user_id}/tracker/events'
-    headers = {'Content-Type': 'application/json'}
-    data = '[{"event": "pause"}]'
-    response = requests.post(endpoint, headers=headers, data=data, timeout=60)
-
-    if response.status_code != 200:
+    if send_tracker_events(user_id, [{'event': 'pause'}]) != 200:
         logging.info('Exception during pause_conversation')
         raise Exception()
 
@@ -415,7 +666,10 @@ def pause_and_resume(self,  # pylint: disable=unused-argument
         time: time for scheduling the dialog resume
         dialog_status: set the dialog state in the fsm after resuming
     """
-    pause_conversation.apply_async(args=[user_id])
+    if send_tracker_events(user_id, [{'event': 'pause'}]) != 200:
+        logging.info('Exception during pause_and_resume')
+        raise Exception()
+
     resume.apply_async(args=[user_id, dialog_status], eta=time)
 
 
@@ -435,7 +689,10 @@ def pause_and_trigger(self,  # pylint: disable=unused-argument
         When the FSM in acknowledged, the trigger will result in the full process of starting a new
         dialog, so new entry is added to the DB and the starting time of the dialog is updated.
     """
-    pause_conversation.apply_async(args=[user_id])
+    if send_tracker_events(user_id, [{'event': 'pause'}]) != 200:
+        logging.info('Exception during pause_and_trigger')
+        raise Exception()
+
     resume_and_trigger.apply_async(args=[user_id, trigger, acknowledge], eta=time)
 
 
@@ -449,12 +706,7 @@ def resume(self,  # pylint: disable=unused-argument
         user_id: the ID of the user to send the trigger to
         dialog_status: set the dialog state in the fsm
     """
-    endpoint = f'http://rasa_server:5005/conversations/{user_id}/tracker/events'
-    headers = {'Content-Type': 'application/json'}
-    data = '[{"event": "resume"}]'
-    response = requests.post(endpoint, headers=headers, data=data, timeout=60)
-
-    if response.status_code != 200:
+    if send_tracker_events(user_id, [{'event': 'resume'}]) != 200:
         logging.info('Exception during resume')
         raise Exception()
 
@@ -476,12 +728,9 @@ def resume_and_trigger(self,  # pylint: disable=unused-argument
         trigger: the intent to be sent after the dialog is resumed
         acknowledge: if true, use the trigger_intervention_component task, to acknowledge the FSM
     """
-    endpoint = f'http://rasa_server:5005/conversations/{user_id}/tracker/events'
-    headers = {'Content-Type': 'application/json'}
-    data = '[{"event": "resume"}]'
-    response_resume = requests.post(endpoint, headers=headers, data=data, timeout=60)
-
-    if response_resume.status_code != 200:
+    # rasa does not predict actions for a paused conversation, so the resume has to be
+    # applied before the intent is triggered
+    if send_tracker_events(user_id, [{'event': 'resume'}]) != 200:
         raise Exception()
 
     if acknowledge:
@@ -495,6 +744,23 @@ def resume_and_trigger(self,  # pylint: disable=unused-argument
             raise Exception()
 
 
+def send_tracker_events(user_id: int, events: List[Dict[str, Any]]) -> int:
+    """
+    Append a list of events to the tracker of a user in rasa, with a single HTTP post request.
+    Args:
+        user_id: ID of the user whose tracker is updated
+        events: the events to be appended, in order
+
+    Returns: the status code of the response
+
+    """
+    endpoint = f'{RASA_URL}/conversations/{user_id}/tracker/events'
+
+    response = rasa_session.post(endpoint, json=events, timeout=RASA_TIMEOUT)
+
+    return response.status_code
+
+
 def send_trigger(user_id: int, trigger: str):
     """
     Prepare and send the HTTP post request to rasa for triggering an intent.
@@ -508,12 +774,11 @@ def send_trigger(user_id: int, trigger: str):
 
     logging.info(f'received send_trigger tasks with {trigger} for {user_id}')
 
-    endpoint = f'http://rasa_server:5005/conversations/{user_id}/trigger_intent'
-    headers = {'Content-Type': 'application/json'}
+    endpoint = f'{RASA_URL}/conversations/{user_id}/trigger_intent'
     params = {'output_channel': 'latest'}
-    data = '{"name": "' + trigger + '" }'
 
-    response_intent = requests.post(endpoint, headers=headers, params=params, data=data, timeout=60)
+    response_intent = rasa_session.post(endpoint, params=params, json={'name': trigger},
+                                        timeout=RASA_TIMEOUT)
 
     res_json = response_intent.json()
 
@@ -1,13 +1,29 @@
+import json
+import numpy as np
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
-from sensorapi.connector import get_steps_data, get_step_goals_and_steps
+from redis.exceptions import LockError, RedisError
+from redis.lock import Lock
+from sensorapi.connector import (STEP_GOAL_WINDOW, compute_step_goals,
+                                 get_steps_per_day_of_users, stack_steps_data, to_date)
 from state_machine.const import (TIMEZONE, MAXIMUM_DIALOG_DURATION, NOTIFY,
-                                 NOT_RUNNING, RUNNING, EXPIRED)
+                                 NOT_RUNNING, RUNNING, EXPIRED, RELAPSE_DAYS,
+                                 RELAPSE_MISSED_DAYS, RELAPSE_MISSED_IN_A_ROW,
+                                 RELAPSE_SUFFICIENT_STEPS, RELAPSE_FETCH_WORKERS,
+                                 FSM_LOCK_KEY, FSM_FENCE_KEY, FSM_LOCK_TIMEOUT, FSM_LOCK_WAIT,
+                                 FSM_JOURNAL_KEY, FSM_SNAPSHOT_KEY)
 from state_machine.controller import (OnboardingState, TrackingState, GoalsSettingState,
                                       BufferState, ExecutionRunState, RelapseState, ClosingState,
                                       CompletedState)
 from state_machine.state import State
 from state_machine.state_machine import StateMachine, DialogState, Event
-from typing import List, Optional
+from state_machine.state_machine_utils import (collect_side_effects, find_in_catalog,
+                                               get_cached_fsm, invalidate_cached_fsm,
+                                               journal_fsm_write, publish_side_effects,
+                                               redis_client, set_cached_fsm)
+from sqlalchemy import func, update
+from sqlalchemy.exc import SQLAlchemyError
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 from virtual_coach_db.dbschema.models import (InterventionComponents, Users, UserInterventionState,
                                               UserStateMachine)
 from virtual_coach_db.helper.definitions import Components, Notifications
@@ -15,6 +31,18 @@ from virtual_coach_db.helper.helper_functions import get_db_session
 
 import logging
 
+# classes implementing the states of the intervention, by the state name stored in the DB
+STATES = {
+    State.ONBOARDING: OnboardingState,
+    State.TRACKING: TrackingState,
+    State.GOALS_SETTING: GoalsSettingState,
+    State.BUFFER: BufferState,
+    State.EXECUTION_RUN: ExecutionRunState,
+    State.RELAPSE: RelapseState,
+    State.CLOSING: ClosingState,
+    State.COMPLETED: CompletedState
+}
+
 
 def check_if_user_exists(user_id: int) -> bool:
     """
@@ -35,6 +63,27 @@ def check_if_user_exists(user_id: int) -> bool:
     return False
 
 
+def get_existing_user_ids(user_ids: List[int]) -> Set[int]:
+    """
+    Check which of the specified users exist already in the db, with a single query.
+    Args:
+        user_ids: the IDs of the users
+    Returns: the set of the IDs of the users that exist
+    """
+    if not user_ids:
+        return set()
+
+    session = get_db_session()
+
+    users = (session.query(Users.nicedayuid)
+             .filter(Users.nicedayuid.in_(user_ids))
+             .all())
+
+    session.close()
+
+    return {user.nicedayuid for user in users}
+
+
 def check_if_user_active(user_id: int, current_date: date, days_number) -> bool:
     """
    Check if a user has been inactive (a dialog has been completed) for a certain number of days.
@@ -69,6 +118,38 @@ def check_if_user_active(user_id: int, current_date: date, days_number) -> bool:
     return completed
 
 
+def get_last_completion_times(current_date: date, days_number: int) -> Dict[int, datetime]:
+    """
+    Get for all the users the time of the latest completed dialog, if it is within a certain
+    number of days. The users without a completed dialog in that period are not included.
+    Args:
+        current_date: the date to start looking backward from
+        days_number: number of days to check the inactivity
+    Returns: a dictionary with the ID of the users active in the period as key, and the time
+    of their latest completed dialog as value
+    """
+    session = get_db_session()
+
+    latest_date = current_date - timedelta(days=days_number)
+
+    last_completed = (
+        session.query(
+            UserInterventionState.users_nicedayuid,
+            func.max(UserInterventionState.last_time)
+        )
+        .filter(
+            UserInterventionState.completed.is_(True),
+            UserInterventionState.last_time > latest_date
+        )
+        .group_by(UserInterventionState.users_nicedayuid)
+        .all()
+    )
+
+    session.close()
+
+    return dict(last_completed)
+
+
 def check_if_physical_relapse(user_id: int, current_date: datetime) -> bool:
     """
     Check if a user has a physical relapse (not reaching the steps goal).
@@ -78,30 +159,50 @@ def check_if_physical_relapse(user_id: int, current_date: datetime) -> bool:
         be considered.
     Returns: True if there is a relapse, false otherwise
     """
-    relapse = False
-
-    end = current_date
-    start = end - timedelta(days=5)
-    # get the list of steps per day
-    steps_data = get_steps_data(user_id, start, end)
-    step_goal, step_array, _, _ = get_step_goals_and_steps(steps_data, start, end)
-
-    # if no steps have been recorded in the past 5 days
-    if steps_data is None:
-        relapse = True
-    # if more than 8000 steps have been taken in the last day it's not a relapse
-    elif (steps_data[-1]['date'].strftime('%y%m%d') == end.strftime('%y%m%d')
-          and steps_data[-1]['steps'] > 8000):
-        relapse = False
-    else:
-        step_goal, step_array, _, _ = get_step_goals_and_steps(steps_data, start, end)
-        # create a list of bool, true if the goal was reached
-        reached_array = [step >= goal for step, goal in zip(step_array, step_goal)]
-        # if goal not reached 4 times in 5 days or 3 days in a row
-        if sum(reached_array) < 4 or sum(reached_array[-3:]) == 3:
-            relapse = True
+    return user_id in get_physical_relapse_users([user_id], current_date)
 
-    return relapse
+
+def get_physical_relapse_users(user_ids: List[int], current_date: datetime) -> List[int]:
+    """
+    Check which users have a physical relapse, i.e., they did not reach the steps goal 4 times
+    in the previous 5 days, or 3 days in a row. If more than 8000 steps have been taken
+    in the last day, it is not a relapse. The goal of each day is computed on the 9 days
+    before it. The steps of all the users are requested in parallel, and the rule is
+    evaluated on the whole cohort at once.
+    Args:
+        user_ids: the IDs of the users
+        current_date: the day in which to check if a relapse occurred. The previous 5 days will
+        be considered.
+    Returns: the IDs of the users in relapse. The users whose steps could not be retrieved
+    are excluded.
+    """
+    end = to_date(current_date)
+    start = end - timedelta(days=RELAPSE_DAYS + STEP_GOAL_WINDOW)
+
+    steps_per_user = get_steps_per_day_of_users(user_ids, start, end,
+                                                workers=RELAPSE_FETCH_WORKERS)
+
+    available = [steps_per_day is not None for steps_per_day in steps_per_user]
+    for user_id, user_available in zip(user_ids, available):
+        if not user_available:
+            logging.warning(f"Steps of user {user_id} not available, relapse not checked")
+
+    steps = stack_steps_data([[{'date': day, 'steps': value} for day, value in
+                               (steps_per_day or {}).items()]
+                              for steps_per_day in steps_per_user], start, end)
+
+    # the goal of each of the last days, and the steps taken in those days
+    step_goals = compute_step_goals(steps, num_goals=RELAPSE_DAYS)
+    actual_steps = steps[:, -RELAPSE_DAYS:]
+
+    missed = actual_steps < step_goals
+    missed_in_a_row = np.all(missed[:, -RELAPSE_MISSED_IN_A_ROW:], axis=1)
+
+    relapse = ((missed.sum(axis=1) >= RELAPSE_MISSED_DAYS) | missed_in_a_row)
+    relapse &= actual_steps[:, -1] <= RELAPSE_SUFFICIENT_STEPS
+    relapse &= np.array(available, dtype=bool)
+
+    return [user_id for user_id, user_relapse in zip(user_ids, relapse) if user_relapse]
 
 
 def check_if_task_executed(task_uuid: str) -> bool:
@@ -154,6 +255,98 @@ def create_new_user(user_id: int):
     session.close()
 
 
+def create_new_users(user_ids: List[int]) -> List[int]:
+    """
+    Initialize the DB for several new users, inserting their profiles and their state
+    machines with a single transaction. The users must not exist already in the DB.
+    If the transaction fails, the users are inserted one at a time, so that a failing user
+    does not prevent the creation of the others.
+    Args:
+        user_ids: the IDs of the users
+
+    Returns: the IDs of the users created
+
+    """
+    if not user_ids:
+        return []
+
+    starting_time = datetime.now().astimezone(TIMEZONE)
+    dialog = get_intervention_component(Components.PREPARATION_INTRODUCTION)
+
+    session = get_db_session()
+
+    def insert_users(ids: List[int]):
+        session.add_all([create_new_user_profile(user_id) for user_id in ids])
+        # the profiles are inserted first, since the state machines reference them
+        session.flush()
+        session.add_all([
+            UserStateMachine(users_nicedayuid=user_id,
+                             state=OnboardingState(user_id).__state__(),
+                             dialog_running=False,
+                             dialog_start_time=starting_time,
+                             intervention_component_id=dialog.intervention_component_id)
+            for user_id in ids])
+        session.commit()
+
+    try:
+        insert_users(user_ids)
+        created = list(user_ids)
+    except SQLAlchemyError:
+        session.rollback()
+        logging.warning('New users not created together, creating them one at a time')
+
+        created = []
+        for user_id in user_ids:
+            try:
+                insert_users([user_id])
+                created.append(user_id)
+            except SQLAlchemyError:
+                session.rollback()
+                logging.exception(f'User {user_id} not created')
+
+    session.close()
+
+    for user_id in created:
+        journal_fsm_write(user_id, 'created', None,
+                          {'state': OnboardingState(user_id).__state__(),
+                           'dialog_running': False,
+                           'dialog_start_time': starting_time.isoformat(),
+                           'current_dialog': Components.PREPARATION_INTRODUCTION},
+                          complete=True)
+
+    return created
+
+
+def delete_new_users(user_ids: List[int]):
+    """
+    Remove from the DB the profiles and the state machines of users just created by
+    create_new_users, whose intervention has not started.
+    Args:
+        user_ids: the IDs of the users
+    """
+    if not user_ids:
+        return
+
+    session = get_db_session()
+
+    (session.query(UserStateMachine)
+     .filter(UserStateMachine.users_nicedayuid.in_(user_ids))
+     .delete(synchronize_session=False))
+    (session.query(Users)
+     .filter(Users.nicedayuid.in_(user_ids))
+     .delete(synchronize_session=False))
+    session.commit()
+
+    session.close()
+
+    # the journals are removed too, otherwise the state machines could be rebuilt
+    try:
+        redis_client.delete(*[key.format(user_id) for user_id in user_ids
+                              for key in (FSM_JOURNAL_KEY, FSM_SNAPSHOT_KEY)])
+    except RedisError as error:
+        logging.warning(f'Journals of the users {user_ids} not removed: {error}')
+
+
 def create_new_user_profile(user_id: int) -> Users:
     """
     Creates a new Users object for the user specified.
@@ -195,14 +388,32 @@ def create_new_user_fsm(user_id: int) -> UserStateMachine:
 def get_all_fsm() -> List[StateMachine]:
     """
     Get the state machines as saved in the DB for all the users and maps them
-    to a list of StateMachine objects
+    to a list of StateMachine objects. The users who completed the intervention are excluded.
+    The state machines and their current dialog are retrieved with a single query.
 
-    Returns: The list of UserStateMachine objects for all the users, representing
-    the user_state_machine table on the DB
+    Returns: The list of StateMachine objects for all the users
 
        """
-    fsm_list = get_all_fsm_from_db()
-    state_machines = [get_user_fsm(fsm.users_nicedayuid) for fsm in fsm_list]
+    session = get_db_session()
+
+    rows = (session.query(UserStateMachine.users_nicedayuid,
+                          UserStateMachine.state,
+                          UserStateMachine.dialog_running,
+                          UserStateMachine.dialog_start_time,
+                          InterventionComponents.intervention_component_name)
+            .join(InterventionComponents,
+                  InterventionComponents.intervention_component_id
+                  == UserStateMachine.intervention_component_id)
+            .filter(UserStateMachine.state != State.COMPLETED)
+            .all())
+
+    session.close()
+
+    state_machines = [StateMachine(create_state(row.users_nicedayuid, row.state),
+                                   DialogState(running=row.dialog_running,
+                                               starting_time=row.dialog_start_time,
+                                               current_dialog=row.intervention_component_name))
+                      for row in rows]
 
     return state_machines
 
@@ -247,20 +458,9 @@ def get_component_name(intervention_component_trigger: str) -> str:
             The intervention component name.
 
     """
-    session = get_db_session()
+    selected = find_in_catalog('components_by_trigger', intervention_component_trigger)
 
-    selected = (
-        session.query(
-            InterventionComponents
-        )
-        .filter(
-            InterventionComponents.intervention_component_trigger == intervention_component_trigger
-        )
-        .first()
-    )
-    component_name = selected.intervention_component_name
-    session.close()
-    return component_name
+    return selected.intervention_component_name
 
 
 def get_dialog_state(state_machine: StateMachine) -> int:
@@ -276,9 +476,10 @@ def get_dialog_state(state_machine: StateMachine) -> int:
     last_time = state_machine.dialog_state.get_running_time()
 
     now = datetime.now().astimezone(TIMEZONE)
+    elapsed = (now - last_time).total_seconds()
 
     logging.info("FSM status: %s", status)
-    logging.info("FSM time: %s", (now - last_time).seconds)
+    logging.info("FSM time: %s", elapsed)
     logging.info("FSM id: %s", state_machine.machine_id)
 
     # dialog not running and completed
@@ -287,10 +488,10 @@ def get_dialog_state(state_machine: StateMachine) -> int:
 
     else:
         # dialog running and in the maximum allowed time
-        if (now - last_time).seconds < MAXIMUM_DIALOG_DURATION:
+        if elapsed < MAXIMUM_DIALOG_DURATION:
             dialog_state = RUNNING
         # dialog not completed, user notified to resume the dialog
-        elif (now - last_time).seconds > 2 * MAXIMUM_DIALOG_DURATION:
+        elif elapsed > 2 * MAXIMUM_DIALOG_DURATION:
             dialog_state = EXPIRED
         else:
             # dialog running but the maximum time elapsed
@@ -299,6 +500,82 @@ def get_dialog_state(state_machine: StateMachine) -> int:
     return dialog_state
 
 
+def get_overdue_dialogs() -> Tuple[List[int], List[Tuple[int, str]]]:
+    """
+    Get the users whose dialog is running for longer than the maximum allowed time, without
+    loading the state machines of the other users. The dialogs are classified as in
+    get_dialog_state: the users running a dialog for more than MAXIMUM_DIALOG_DURATION
+    have to be notified, and after twice that time the dialog is expired.
+
+    Returns: the IDs of the users to be notified, and the IDs of the users with an expired
+    dialog together with the name of the dialog
+
+    """
+    now = datetime.now().astimezone(TIMEZONE)
+    expired_before = now - timedelta(seconds=2 * MAXIMUM_DIALOG_DURATION)
+
+    session = get_db_session()
+
+    rows = (session.query(UserStateMachine.users_nicedayuid,
+                          UserStateMachine.dialog_start_time,
+                          InterventionComponents.intervention_component_name)
+            .join(InterventionComponents,
+                  InterventionComponents.intervention_component_id
+                  == UserStateMachine.intervention_component_id)
+            .filter(UserStateMachine.state != State.COMPLETED,
+                    UserStateMachine.dialog_running.is_(True),
+                    UserStateMachine.dialog_start_time
+                    <= now - timedelta(seconds=MAXIMUM_DIALOG_DURATION))
+            .all())
+
+    session.close()
+
+    notify_users = [row.users_nicedayuid for row in rows
+                    if row.dialog_start_time >= expired_before]
+    expired_dialogs = [(row.users_nicedayuid, row.intervention_component_name) for row in rows
+                       if row.dialog_start_time < expired_before]
+
+    return notify_users, expired_dialogs
+
+
+def set_expired_dialogs_to_idle(user_ids: List[int]) -> List[int]:
+    """
+    Set the dialog of the users to idle with a single update, if it is still expired
+    (i.e., no new dialog has started in the meanwhile).
+    Args:
+        user_ids: the IDs of the users with an expired dialog
+
+    Returns: the IDs of the users whose state machine has been updated
+
+    """
+    if not user_ids:
+        return []
+
+    expired_before = (datetime.now().astimezone(TIMEZONE)
+                      - timedelta(seconds=2 * MAXIMUM_DIALOG_DURATION))
+
+    session = get_db_session()
+
+    result = session.execute(update(UserStateMachine)
+                             .where(UserStateMachine.users_nicedayuid.in_(user_ids),
+                                    UserStateMachine.dialog_running.is_(True),
+                                    UserStateMachine.dialog_start_time < expired_before)
+                             .values({UserStateMachine.dialog_running: False})
+                             .returning(UserStateMachine.users_nicedayuid)
+                             .execution_options(synchronize_session=False))
+    updated = [user_id for user_id, in result]
+    session.commit()
+
+    session.close()
+
+    invalidate_cached_fsm(*updated)
+
+    for user_id in updated:
+        journal_fsm_write(user_id, 'dialog_expired', None, {'dialog_running': False})
+
+    return updated
+
+
 def get_intervention_component(intervention_component_name: str) -> InterventionComponents:
     """
     Get the intervention component as stored in the DB from the
@@ -313,22 +590,7 @@ def get_intervention_component(intervention_component_name: str) -> Intervention
             The intervention component as an InterventionComponents object.
 
     """
-    session = get_db_session()
-
-    selected = (
-        session.query(
-            InterventionComponents
-        )
-        .filter(
-            InterventionComponents.intervention_component_name == intervention_component_name
-        )
-        .one_or_none()
-    )
-
-    session.expunge(selected)
-    session.close()
-
-    return selected
+    return find_in_catalog('components_by_name', intervention_component_name)
 
 
 def get_intervention_component_by_id(intervention_component_id: int) -> InterventionComponents:
@@ -343,34 +605,27 @@ def get_intervention_component_by_id(intervention_component_id: int) -> Interven
             The intervention component as an InterventionComponents object.
 
     """
-    session = get_db_session()
-
-    selected = (
-        session.query(
-            InterventionComponents
-        )
-        .filter(
-            InterventionComponents.intervention_component_id == intervention_component_id
-        )
-        .one_or_none()
-    )
+    return find_in_catalog('components_by_id', intervention_component_id)
 
-    session.expunge(selected)
-    session.close()
 
-    return selected
-
-
-def get_user_fsm(user_id: int) -> StateMachine:
+def get_user_fsm(user_id: int, lock: Optional[Lock] = None) -> StateMachine:
     """
     Get the state machine as saved in the DB for a single user and maps it
-    to a StateMachine object
+    to a StateMachine object. The state machine is read from the cache, and
+    the DB is queried only if it is not cached.
     Args:
         user_id: the id of the user
+        lock: the lock of the user's state machine, if held. The state machine read from the
+        DB is cached only under the lock, with the version of the lock, so that it cannot
+        replace a newer state machine or the invalidation of a concurrent write.
 
     Returns: The UserStateMachine object representing the user_state_machine table on the DB
 
     """
+    cached = get_cached_fsm(user_id)
+    if cached is not None:
+        return deserialize_state_machine(user_id, cached)
+
     fsm = get_user_fsm_from_db(user_id)
 
     if fsm is None:
@@ -379,56 +634,114 @@ def get_user_fsm(user_id: int) -> StateMachine:
                                    starting_time=datetime.now(tz=TIMEZONE),
                                    current_dialog=Components.PREPARATION_INTRODUCTION)
     else:
-        state_saved = fsm.state
+        state = create_state(user_id, fsm.state)
 
-        if state_saved == State.ONBOARDING:
-            state = OnboardingState(user_id)
+        component_saved = find_in_catalog('components_by_id', fsm.intervention_component_id)
 
-        elif state_saved == State.TRACKING:
-            state = TrackingState(user_id)
+        dialog_state = DialogState(running=fsm.dialog_running,
+                                   starting_time=fsm.dialog_start_time,
+                                   current_dialog=component_saved.intervention_component_name)
 
-        elif state_saved == State.GOALS_SETTING:
-            state = GoalsSettingState(user_id)
+    user_fsm = StateMachine(state, dialog_state)
 
-        elif state_saved == State.BUFFER:
-            state = BufferState(user_id)
+    if fsm is not None and lock is not None:
+        set_cached_fsm(user_id, serialize_state_machine(user_fsm), version=lock.local.version)
 
-        elif state_saved == State.EXECUTION_RUN:
-            state = ExecutionRunState(user_id)
+    return user_fsm
 
-        elif state_saved == State.RELAPSE:
-            state = RelapseState(user_id)
 
-        elif state_saved == State.CLOSING:
-            state = ClosingState(user_id)
+def serialize_state_machine(state_machine: StateMachine) -> Dict[str, Any]:
+    """
+    Serialize a state machine to be cached
+    Args:
+        state_machine: the state machine to be serialized
 
-        elif state_saved == State.COMPLETED:
-            state = CompletedState(user_id)
+    Returns: dictionary with the state name, the dialog running flag, the dialog
+    starting time and the current dialog. The starting time is serialized as it is, so
+    that it is compared exactly with the value saved in the DB.
 
-        else:
-            state = OnboardingState(user_id)
+    """
+    dialog_state = state_machine.dialog_state
+    starting_time = dialog_state.get_running_time()
 
-        session = get_db_session()
+    return {'state': state_machine.state.__state__(),
+            'dialog_running': dialog_state.get_running_status(),
+            'dialog_start_time': starting_time.isoformat() if starting_time is not None else None,
+            'current_dialog': dialog_state.get_current_dialog()}
 
-        component_saved = (
-            session.query(
-                InterventionComponents
-            )
-            .filter(
-                InterventionComponents.intervention_component_id == fsm.intervention_component_id
-            )
-            .one()
-        )
 
-        dialog_state = DialogState(running=fsm.dialog_running,
-                                   starting_time=fsm.dialog_start_time,
-                                   current_dialog=component_saved.intervention_component_name)
+def serialize_db_state_machine(fsm_db: UserStateMachine) -> Dict[str, Any]:
+    """
+    Serialize a state machine as saved in the DB, in the format of serialize_state_machine
+    Args:
+        fsm_db: the UserStateMachine object read from the DB
 
-        session.close()
+    Returns: dictionary with the state name, the dialog running flag, the dialog
+    starting time and the current dialog
 
-    user_fsm = StateMachine(state, dialog_state)
+    """
+    starting_time = fsm_db.dialog_start_time
+    component = find_in_catalog('components_by_id', fsm_db.intervention_component_id)
 
-    return user_fsm
+    return {'state': fsm_db.state,
+            'dialog_running': fsm_db.dialog_running,
+            'dialog_start_time': starting_time.isoformat() if starting_time is not None else None,
+            'current_dialog': component.intervention_component_name}
+
+
+def get_state_machine_db_values(serialized: Dict[str, Any]) -> Dict[Any, Any]:
+    """
+    Get the values of the columns of the user_state_machine table for a serialized state machine
+    Args:
+        serialized: the state machine, as returned by serialize_state_machine
+
+    Returns: dictionary with the values of the state, dialog running flag, dialog starting
+    time and intervention component columns
+
+    """
+    starting_time = serialized['dialog_start_time']
+    dialog = get_intervention_component(serialized['current_dialog'])
+
+    return {UserStateMachine.state: serialized['state'],
+            UserStateMachine.dialog_running: serialized['dialog_running'],
+            UserStateMachine.dialog_start_time: (datetime.fromisoformat(starting_time)
+                                                 if starting_time is not None else None),
+            UserStateMachine.intervention_component_id: dialog.intervention_component_id}
+
+
+def deserialize_state_machine(user_id: int, serialized: Dict[str, Any]) -> StateMachine:
+    """
+    Create the state machine of a user from its serialized version
+    Args:
+        user_id: the id of the user
+        serialized: the state machine, as returned by serialize_state_machine
+
+    Returns: the StateMachine object
+
+    """
+    starting_time = serialized['dialog_start_time']
+
+    dialog_state = DialogState(running=serialized['dialog_running'],
+                               starting_time=(datetime.fromisoformat(starting_time)
+                                              if starting_time is not None else None),
+                               current_dialog=serialized['current_dialog'])
+
+    return StateMachine(create_state(user_id, serialized['state']), dialog_state)
+
+
+def create_state(user_id: int, state_saved: str) -> State:
+    """
+    Create the state of a user's state machine from the state name saved in the DB
+    Args:
+        user_id: the id of the user
+        state_saved: the name of the state, as defined in State
+
+    Returns: The state object. Unknown states are mapped to the onboarding state
+
+    """
+    state_class = STATES.get(state_saved, OnboardingState)
+
+    return state_class(user_id)
 
 
 def get_scheduled_task_from_db() -> List[UserInterventionState]:
@@ -465,6 +778,37 @@ def get_scheduled_task_from_db() -> List[UserInterventionState]:
     return tasks_copy
 
 
+def get_scheduled_task_triggers_from_db() -> List[Tuple[str, int, str, datetime]]:
+    """
+    Get all the tasks scheduled and not yet executed as they are stored in the DB, together
+    with the trigger of the intervention component they deliver.
+    Returns: A list of tuples with the task uuid, the user ID, the intervention component
+    trigger and the delivery time.
+    """
+
+    now = datetime.now().astimezone(TIMEZONE)
+
+    session = get_db_session()
+
+    tasks = (session.query(UserInterventionState.task_uuid,
+                           UserInterventionState.users_nicedayuid,
+                           InterventionComponents.intervention_component_trigger,
+                           UserInterventionState.next_planned_date)
+             .join(InterventionComponents,
+                   InterventionComponents.intervention_component_id
+                   == UserInterventionState.intervention_component_id)
+             .filter(
+        UserInterventionState.completed.is_(False),
+        UserInterventionState.task_uuid.isnot(None),
+        UserInterventionState.next_planned_date.isnot(None),
+        UserInterventionState.next_planned_date >= now)
+             .all())
+
+    session.close()
+
+    return [tuple(task) for task in tasks]
+
+
 def get_user_fsm_from_db(user_id: int) -> Optional[UserStateMachine]:
     """
     Get the state machine as saved in the DB for a single user
@@ -569,30 +913,115 @@ def save_user_to_db(user: Users):
     session.close()
 
 
-def save_state_machine_to_db(state_machine: StateMachine):
+@contextmanager
+def user_fsm_lock(user_id: int) -> Iterator[Lock]:
+    """
+    Lock the state machine of a user, so that the events of the same user are processed one
+    at a time, while the events of different users are processed in parallel.
+    Each acquisition gets a version (lock.local.version), incremented once the lock is held,
+    so that the versions follow the order of the acquisitions. The version orders the
+    state machines written to the cache. save_state_machine_to_db renews the lock before the
+    commit, and does not save the state machine if the lock expired.
+    Args:
+        user_id: the ID of the user
+
+    Raises: LockError if the lock is not acquired within FSM_LOCK_WAIT seconds
+
+    """
+    lock = redis_client.lock(FSM_LOCK_KEY.format(user_id), timeout=FSM_LOCK_TIMEOUT)
+
+    if not lock.acquire(blocking_timeout=FSM_LOCK_WAIT):
+        raise LockError(f'The state machine of the user {user_id} is locked')
+
+    try:
+        lock.local.version = redis_client.incr(FSM_FENCE_KEY.format(user_id))
+        yield lock
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logging.warning('The lock of the state machine of the user %s expired before '
+                            'being released', user_id)
+
+
+def save_state_machine_to_db(state_machine: StateMachine,
+                             lock: Optional[Lock] = None,
+                             previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Saves the StateMachine object to the database. if the user id exists,
     the record will be updated, while a new record will be created otherwise.
+    If the state machine has been read before, the row is updated only if it has not been
+    changed since (compare-and-set). Otherwise, the row has been changed by a concurrent
+    write (e.g. set_expired_dialogs_to_idle), and the fields changed by this write are
+    applied on top of it.
     Args:
         state_machine: StateMachine object to be stored
+        lock: the lock of the user's state machine, if held. The state machine is saved only
+        if the lock is still owned, and the lock timeout is renewed.
+        previous: the serialized state machine, as it was read before being changed. If None,
+        the row is overwritten.
+
+    Returns: the serialized state machine, as saved in the DB
+
+    Raises: LockNotOwnedError if the lock expired and has been acquired by another task
 
     """
     user_id = state_machine.machine_id
 
-    fsm_db = map_state_machine_to_db(state_machine)
+    saved = serialize_state_machine(state_machine)
 
-    user_fsm = get_user_fsm_from_db(user_id)
+    session = get_db_session()
 
-    # if a machine already exists, use the same primary key to update the row
-    if user_fsm is not None:
-        fsm_db.state_machine_id = user_fsm.state_machine_id
+    query = session.query(UserStateMachine).filter(UserStateMachine.users_nicedayuid == user_id)
+
+    if previous is None:
+        updated = query.update(get_state_machine_db_values(saved), synchronize_session=False)
+    else:
+        expected = [column.is_(None) if value is None else column == value
+                    for column, value in get_state_machine_db_values(previous).items()]
+
+        updated = (query.filter(*expected)
+                   .update(get_state_machine_db_values(saved), synchronize_session=False))
+
+        # no row has been updated: the row is missing, or it has been changed. In the latter
+        # case it is locked until the commit, and updated with the changes of this write
+        fsm_db = query.with_for_update().first() if updated == 0 else None
+
+        if fsm_db is not None:
+            current = serialize_db_state_machine(fsm_db)
+            changes = {field: value for field, value in saved.items()
+                       if previous.get(field) != value}
+            saved = {**current, **changes}
+
+            updated = query.update(get_state_machine_db_values(saved), synchronize_session=False)
+
+            if current != previous:
+                logging.info('The state machine of the user %s has been changed by a concurrent '
+                             'write, saving the changes %s on top of it', user_id, changes)
+
+    # the row is inserted if missing
+    if updated == 0:
+        session.add(map_state_machine_to_db(state_machine))
+
+    if lock is not None:
+        lock.reacquire()
+        # the version is taken before the commit: the writes committed later without the lock
+        # invalidate the cache with a newer version
+        lock.local.version = redis_client.incr(FSM_FENCE_KEY.format(user_id))
 
-    session = get_db_session()
-    session.merge(fsm_db)
     session.commit()
 
     session.close()
 
+    # the cached state machine is replaced only by a newer one, identified by the version
+    # of the lock. Without a lock the version is unknown, so the cache is invalidated
+    if lock is not None:
+        set_cached_fsm(user_id, saved, version=lock.local.version)
+    else:
+        invalidate_cached_fsm(user_id)
+
+    return saved
+
 
 def send_fsm_event(user_id: int, event: Event):
     """
@@ -603,13 +1032,35 @@ def send_fsm_event(user_id: int, event: Event):
 
     """
 
-    user_fsm = get_user_fsm(user_id)
+    with user_fsm_lock(user_id) as lock:
+        user_fsm = get_user_fsm(user_id, lock)
+        previous = serialize_state_machine(user_fsm)
+
+        logging.info('Event sending from celery task: %s %s', event.EventType, event.Descriptor)
+        logging.info('Current machine state: %s', user_fsm.state.__state__())
+
+        # the tasks emitted by the states are published only once the state machine is saved.
+        # The states commit their own DB writes (e.g., the dialogs planned with their task
+        # uuids), so the side effects collected are published also if the event fails
+        with collect_side_effects() as outbox:
+            try:
+                user_fsm.on_event(event)
+            except Exception:
+                publish_side_effects(outbox)
+                raise
 
-    logging.info('Event sending from celery task: %s %s', event.EventType, event.Descriptor)
-    logging.info('Current machine state: %s', user_fsm.state.__state__())
-    user_fsm.on_event(event)
+        # the fields written by the states are saved with the state machine
+        writes = outbox.fsm_writes.get(user_id)
+        if writes:
+            user_fsm = deserialize_state_machine(user_id,
+                                                 {**serialize_state_machine(user_fsm), **writes})
 
-    save_state_machine_to_db(user_fsm)
+        try:
+            saved = save_state_machine_to_db(user_fsm, lock, previous)
+        finally:
+            publish_side_effects(outbox)
+
+        journal_fsm_write(user_id, event.EventType.value, event.Descriptor, saved, complete=True)
 
 
 def set_dialog_running_status(user_id: int, state: bool):
@@ -621,15 +1072,90 @@ def set_dialog_running_status(user_id: int, state: bool):
 
     """
 
-    user_fsm = get_user_fsm(user_id)
+    with user_fsm_lock(user_id) as lock:
+        user_fsm = get_user_fsm(user_id, lock)
+        previous = serialize_state_machine(user_fsm)
 
-    if state:
-        current_dialog = user_fsm.dialog_state.get_current_dialog()
-        user_fsm.dialog_state.set_to_running(current_dialog)
-    else:
-        user_fsm.dialog_state.set_to_idle()
+        if state:
+            current_dialog = user_fsm.dialog_state.get_current_dialog()
+            user_fsm.dialog_state.set_to_running(current_dialog)
+        else:
+            user_fsm.dialog_state.set_to_idle()
+
+        saved = save_state_machine_to_db(user_fsm, lock, previous)
 
-    save_state_machine_to_db(user_fsm)
+        journal_fsm_write(user_id, 'dialog_running_status', state, saved, complete=True)
+
+
+def replay_fsm_journal(user_ids: List[int]) -> Dict[int, StateMachine]:
+    """
+    Rebuild the state machines of the users from their journals, applying to the last
+    snapshot the changes recorded after it. The events are not processed again, so their
+    side effects (e.g., the scheduling of the dialogs) are not repeated.
+    Args:
+        user_ids: the IDs of the users
+
+    Returns: the rebuilt state machines, by user ID. The users without a snapshot are
+    not included.
+
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(FSM_SNAPSHOT_KEY.format(user_id))
+    snapshots = pipe.execute()
+
+    # the entry of the snapshot is included in the range, but its changes are already applied
+    for user_id, snapshot in zip(user_ids, snapshots):
+        pipe.xrange(FSM_JOURNAL_KEY.format(user_id), min=snapshot.get(b'entry_id', b'-'))
+    journals = pipe.execute()
+
+    state_machines = {}
+    for user_id, snapshot, entries in zip(user_ids, snapshots, journals):
+        if b'fsm' not in snapshot:
+            continue
+
+        fsm = json.loads(snapshot[b'fsm'])
+        for entry_id, entry in entries:
+            if entry_id != snapshot[b'entry_id']:
+                fsm.update(json.loads(entry[b'changes']))
+
+        state_machines[user_id] = deserialize_state_machine(user_id, fsm)
+
+    return state_machines
+
+
+def get_journaled_user_ids() -> List[int]:
+    """
+    Get the IDs of all the users with a snapshot of their state machine in the journal
+    """
+    prefix = FSM_SNAPSHOT_KEY.format('')
+
+    return [int(key.decode()[len(prefix):])
+            for key in redis_client.scan_iter(match=f'{prefix}*', count=1000)]
+
+
+def update_task_uuids_db(new_uuids: Dict[str, str]):
+    """
+    Update the uuids of several scheduled tasks stored in the DB with a single transaction
+    Args:
+        new_uuids: dictionary with the uuids stored in the DB as keys, and the new ones as values
+
+    """
+    if not new_uuids:
+        return
+
+    session = get_db_session()
+
+    tasks = (session.query(UserInterventionState)
+             .filter(UserInterventionState.task_uuid.in_(list(new_uuids)))
+             .all())
+
+    for task in tasks:
+        task.task_uuid = new_uuids[task.task_uuid]
+
+    session.commit()
+
+    session.close()
 
 
 def update_task_uuid_db(old_uuid: str, new_uuid: str):
@@ -8,6 +8,8 @@ MAXIMUM_INACTIVE_DAYS = 10
 
 # time interval in seconds for checking for new connection requests
 INVITES_CHECK_INTERVAL = 10*60
+# maximum number of invitation requests accepted concurrently
+INVITES_ACCEPT_WORKERS = 8
 
 # next message is delivered
 WORDS_PER_SECOND = 5
@@ -37,6 +39,9 @@ REDIS_URL = os.getenv('REDIS_URL')
 ENVIRONMENT = os.getenv('ENVIRONMENT')
 DATABASE_URL = os.getenv('DATABASE_URL')
 NICEDAY_API_ENDPOINT = os.getenv('NICEDAY_API_ENDPOINT')
+RASA_URL = 'http://rasa_server:5005'
+# timeout in seconds of the requests to rasa_server
+RASA_TIMEOUT = 60
 TRIGGER_COMPONENT = 'celery_tasks.trigger_intervention_component'
 PAUSE_AND_TRIGGER = 'celery_tasks.pause_and_trigger'
 RESCHEDULE_DIALOG = 'celery_tasks.reschedule_dialog'
@@ -52,3 +57,64 @@ NOTIFY = 3
 
 # definitions of morning hours
 MORNING_TIME = 8
+# hour of the night in which the daily step goals are precomputed
+STEP_GOALS_TIME = 4
+# maximum number of retries for the users whose step goals could not be precomputed
+STEP_GOALS_MAX_RETRIES = 3
+
+# number of users notified of the new day by each task
+NEW_DAY_CHUNK_SIZE = 50
+# maximum number of retries for the users whose new day notification failed
+NEW_DAY_MAX_RETRIES = 3
+# time in seconds for which a user notified of the new day is not notified again
+NEW_DAY_MARKER_EXPIRE = 2*24*60*60
+# time in seconds after which a new day notification still in progress can be sent again
+NEW_DAY_SENDING_EXPIRE = 10*60
+
+# number of past days checked for a physical activity relapse
+RELAPSE_DAYS = 5
+# number of days in which the goal is not reached that define a relapse
+RELAPSE_MISSED_DAYS = 4
+# number of consecutive days in which the goal is not reached that define a relapse
+RELAPSE_MISSED_IN_A_ROW = 3
+# steps in the last day above which the user is never in relapse
+RELAPSE_SUFFICIENT_STEPS = 8000
+# number of users whose steps are requested in parallel
+RELAPSE_FETCH_WORKERS = 16
+
+# redis sorted set with the uuids of the scheduled tasks, by their planned time
+SCHEDULED_TASKS_KEY = 'scheduled_tasks'
+# redis hash with the user and the trigger of each scheduled task
+SCHEDULED_TASKS_PAYLOADS_KEY = 'scheduled_tasks_payloads'
+# interval in seconds between the checks for the scheduled tasks that are due
+TIMER_POLL_INTERVAL = 30
+# time in seconds after which a due task that was claimed but not released is claimed again
+TIMER_LEASE = 5*60
+# maximum number of due tasks claimed at once
+TIMER_BATCH_SIZE = 500
+
+# redis keys of the lock of a user's state machine and of the counter of its cached versions
+FSM_LOCK_KEY = 'fsm_lock:{}'
+FSM_FENCE_KEY = 'fsm_fence:{}'
+# time in seconds after which the lock of a state machine expires, if not released
+FSM_LOCK_TIMEOUT = 5*60
+# maximum time in seconds spent waiting for the lock of a state machine
+FSM_LOCK_WAIT = 60
+# redis key of the cached state machine of a user, and its expiration time in seconds
+FSM_CACHE_KEY = 'fsm:{}'
+FSM_CACHE_EXPIRE = 24*60*60
+# redis keys of the journal of the writes of a user's state machine, and of its last snapshot
+FSM_JOURNAL_KEY = 'fsm_journal:{}'
+FSM_SNAPSHOT_KEY = 'fsm_snapshot:{}'
+# minimum number of entries in the journal between two snapshots
+FSM_SNAPSHOT_INTERVAL = 50
+# number of entries kept in the journal of each user (it must be larger than the interval)
+FSM_JOURNAL_MAX_LENGTH = 20 * FSM_SNAPSHOT_INTERVAL
+# redis key of the plan of the intervention of a user, and its expiration time in seconds
+USER_PLAN_KEY = 'user_plan:{}'
+USER_PLAN_EXPIRE = 7*24*60*60
+
+# port of the Prometheus endpoint with the telemetry of the tasks
+TELEMETRY_PORT = int(os.getenv('TELEMETRY_PORT', '9540'))
+# interval in seconds between the logs of the telemetry summary
+TELEMETRY_LOG_INTERVAL = 60*60
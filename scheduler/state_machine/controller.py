@@ -1,28 +1,27 @@
 import logging
 from celery import Celery
 from datetime import date, datetime, timedelta
-from state_machine.state_machine_utils import (compute_previous_day,
-                                               create_new_date, get_dialog_completion_state,
+from state_machine.state_machine_utils import (create_new_date, get_dialog_completion_state,
                                                get_execution_week, get_intervention_component,
                                                get_activity_completion_state,
                                                get_all_scheduled_occurrence,
                                                get_last_component_state,
                                                get_next_planned_date, get_next_scheduled_occurrence,
                                                get_hrs_last_branch,
-                                               get_preferred_date_time,
-                                               get_quit_date, get_pa_group, get_start_date,
-                                               is_new_week, plan_and_store, plan_every_day_range,
-                                               reschedule_dialog,
-                                               retrieve_tracking_day,
+                                               get_preferred_date_time, get_user_plan,
+                                               get_pa_group, get_start_date,
+                                               is_new_week, plan_and_store, plan_and_store_many,
+                                               plan_every_day_range,
+                                               refresh_user_plan, reschedule_dialog,
                                                run_uncompleted_dialog, run_option_menu,
-                                               save_fsm_state_in_db,
+                                               save_fsm_state_in_db, send_task,
                                                schedule_next_execution, store_completed_dialog,
                                                store_scheduled_dialog, update_execution_week,
                                                update_fsm_dialog_running_status,
                                                dialogs_to_be_completed, get_component_id,
                                                reschedule_weekly_reflection,
                                                plan_new_date_notifications)
-from state_machine.const import (ACTIVITY_C2_9_DAY_TRIGGER, FUTURE_SELF_INTRO, GOAL_SETTING,
+from state_machine.const import (FUTURE_SELF_INTRO, GOAL_SETTING,
                                  TRACKING_DURATION, TIMEZONE, PREPARATION_GA, PAUSE_AND_TRIGGER,
                                  MAX_PREPARATION_DURATION, HIGH_PA_GROUP,
                                  EXECUTION_DURATION_WEEKS, TIME_DELTA_PA_NOTIFICATION, REDIS_URL,
@@ -70,11 +69,11 @@ class OnboardingState(State):
                                    last_time=trigger_time)
 
             # pause the conversation and then trigger the dialog
-            celery.send_task(PAUSE_AND_TRIGGER,
-                             (self.user_id,
-                              ComponentsTriggers.MEDICATION_TALK,
-                              datetime.now() + timedelta(seconds=30),
-                              True))
+            send_task(PAUSE_AND_TRIGGER,
+                      (self.user_id,
+                       ComponentsTriggers.MEDICATION_TALK,
+                       datetime.now() + timedelta(seconds=30),
+                       True))
 
         elif dialog == Components.MEDICATION_TALK:
             # check if the track behavior dialog has to be started (i.e. the coach triggered
@@ -235,6 +234,7 @@ class TrackingState(State):
     def run(self):
         logging.info('Starting Tracking state')
         save_fsm_state_in_db(self.user_id, self.state)
+        refresh_user_plan(self.user_id)
 
         current_date = date.today()
         self.check_if_end_date(current_date)
@@ -243,10 +243,9 @@ class TrackingState(State):
         logging.info('current date: %s', current_date)
 
         # at day 7 activity C2.9 has to be proposed
-        start_date = get_start_date(self.user_id)
-        choose_sport_completed = get_activity_completion_state(self.user_id, 29)
-        if ((current_date - start_date).days >= ACTIVITY_C2_9_DAY_TRIGGER
-                and not choose_sport_completed):
+        plan = get_user_plan(self.user_id)
+        if (plan.is_due('general_activity_date', current_date)
+                and not get_activity_completion_state(self.user_id, 29)):
             if self.check_if_general_activity_dialog_exists():
                 run_uncompleted_dialog(self.user_id, dialog_preference=Components.GENERAL_ACTIVITY)
             else:
@@ -257,12 +256,12 @@ class TrackingState(State):
         self.check_if_end_date(current_date)
 
     def check_if_end_date(self, date_to_check: date) -> bool:
-        tracking_day = retrieve_tracking_day(self.user_id, date_to_check)
+        plan = get_user_plan(self.user_id)
         # the Goal Setting state starts on day 10 of the intervention
 
-        if tracking_day is None:
-            logging.warning(f'Tracking day is not found for user {self.user_id}')
-        elif tracking_day >= TRACKING_DURATION:
+        if plan.goals_setting_date is None:
+            logging.warning(f'Tracking start is not found for user {self.user_id}')
+        elif plan.is_due('goals_setting_date', date_to_check):
             self.set_new_state(GoalsSettingState(self.user_id))
             return True
 
@@ -295,6 +294,8 @@ class GoalsSettingState(State):
 
         if dialog == Components.GOAL_SETTING:
             logging.info('Goal setting completed, starting first aid kit')
+            # the quit date has been set during the dialog
+            refresh_user_plan(self.user_id)
             plan_and_store(user_id=self.user_id,
                            dialog=Components.FIRST_AID_KIT_VIDEO,
                            planned_date=datetime.now() + timedelta(minutes=1),
@@ -332,8 +333,9 @@ class GoalsSettingState(State):
                            phase_id=1)
 
     def plan_buffer_phase_dialogs(self):
-        quit_date = get_quit_date(self.user_id)
-        start_date = get_start_date(self.user_id)
+        plan = get_user_plan(self.user_id)
+        quit_date = plan.quit_date
+        start_date = plan.start_date
 
         if (quit_date - start_date).days >= PREPARATION_GA:
             planned_date = create_new_date(start_date=start_date, time_delta=PREPARATION_GA)
@@ -353,7 +355,7 @@ class GoalsSettingState(State):
     def plan_execution_start_dialog(self):
         # this is the intro video to be sent the first time
         # the execution starts (not after lapse/relapse)
-        quit_date = get_quit_date(self.user_id)
+        quit_date = get_user_plan(self.user_id).quit_date
         planned_date = create_new_date(start_date=quit_date, minute=5)
 
         plan_and_store(user_id=self.user_id,
@@ -371,18 +373,15 @@ class GoalsSettingState(State):
 
         first_date = date.today() + timedelta(days=1)
         # until the execution starts
-        last_date = get_quit_date(self.user_id)
+        last_date = get_user_plan(self.user_id).quit_date
 
         if pa_group == HIGH_PA_GROUP:
             # every 3 days
-            for day in range((last_date - first_date).days)[0::3]:
-                planned_date = create_new_date(start_date=first_date,
-                                               time_delta=day)
-
-                plan_and_store(user_id=self.user_id,
-                               dialog=Notifications.PA_INTENSITY_MINUTES_NOTIFICATION,
-                               planned_date=planned_date,
-                               phase_id=2)
+            plan_and_store_many(user_id=self.user_id,
+                                phase_id=2,
+                                entries=[(Notifications.PA_INTENSITY_MINUTES_NOTIFICATION,
+                                          create_new_date(start_date=first_date, time_delta=day))
+                                         for day in range((last_date - first_date).days)[0::3]])
         # every day (default group 1)
         else:
             plan_every_day_range(user_id=self.user_id,
@@ -394,7 +393,7 @@ class GoalsSettingState(State):
     def run(self):
         save_fsm_state_in_db(self.user_id, self.state)
 
-        start_date = get_start_date(self.user_id)
+        start_date = refresh_user_plan(self.user_id).start_date
 
         # if the starting of this phase is after the expected one
         # launch immediately the goal setting
@@ -412,7 +411,7 @@ class GoalsSettingState(State):
                        phase_id=1)
 
     def check_if_end_date(self, current_date: date):
-        quit_date = get_quit_date(self.user_id)
+        quit_date = get_user_plan(self.user_id).quit_date
 
         if quit_date is None:
             logging.warning(f'Quit date is not found for user {self.user_id}')
@@ -421,8 +420,8 @@ class GoalsSettingState(State):
 
             # on the quit date, notify the user that today is the quit date
             if current_date == quit_date:
-                celery.send_task(TRIGGER_INTENT,
-                                 (self.user_id, NotificationsTriggers.QUIT_DATE_NOTIFICATION))
+                send_task(TRIGGER_INTENT,
+                          (self.user_id, NotificationsTriggers.QUIT_DATE_NOTIFICATION))
 
             self.set_new_state(ExecutionRunState(self.user_id))
 
@@ -437,6 +436,7 @@ class BufferState(State):
     def run(self):
         logging.info('Buffer State running')
         save_fsm_state_in_db(self.user_id, self.state)
+        refresh_user_plan(self.user_id)
         # if the user sets the quit date to the day after the goal
         # setting dialog, the buffer phase can also be immediately over
         self.check_if_end_date(date.today())
@@ -470,7 +470,7 @@ class BufferState(State):
                           phase=1)
 
     def check_if_end_date(self, current_date: date):
-        quit_date = get_quit_date(self.user_id)
+        quit_date = get_user_plan(self.user_id).quit_date
 
         if quit_date is None:
             logging.warning(f'Quit date is not found for user {self.user_id}')
@@ -479,8 +479,8 @@ class BufferState(State):
 
             # on the quit date, notify the user that today is the quit date
             if current_date == quit_date:
-                celery.send_task(TRIGGER_INTENT,
-                                 (self.user_id, NotificationsTriggers.QUIT_DATE_NOTIFICATION))
+                send_task(TRIGGER_INTENT,
+                          (self.user_id, NotificationsTriggers.QUIT_DATE_NOTIFICATION))
 
             self.set_new_state(ExecutionRunState(self.user_id))
 
@@ -521,16 +521,16 @@ class ExecutionRunState(State):
                                        last_time=trigger_time)
 
                 # pause the conversation and then trigger the dialog
-                celery.send_task(PAUSE_AND_TRIGGER,
-                                 (self.user_id,
-                                  ComponentsTriggers.WEEKLY_REFLECTION,
-                                  datetime.now() + timedelta(minutes=1),
-                                  True))
+                send_task(PAUSE_AND_TRIGGER,
+                          (self.user_id,
+                           ComponentsTriggers.WEEKLY_REFLECTION,
+                           datetime.now() + timedelta(minutes=1),
+                           True))
 
         elif dialog == Components.WEEKLY_REFLECTION:
             logging.info('Weekly reflection completed')
 
-            quit_date = get_quit_date(self.user_id)
+            quit_date = refresh_user_plan(self.user_id).quit_date
             current_date = date.today()
 
             # if the quit date is in the future, it has been reset
@@ -583,11 +583,11 @@ class ExecutionRunState(State):
                                        last_time=trigger_time)
 
                 # pause the conversation and then trigger the dialog
-                celery.send_task(PAUSE_AND_TRIGGER,
-                                 (self.user_id,
-                                  ComponentsTriggers.FUTURE_SELF_SHORT,
-                                  datetime.now() + timedelta(minutes=1),
-                                  True))
+                send_task(PAUSE_AND_TRIGGER,
+                          (self.user_id,
+                           ComponentsTriggers.FUTURE_SELF_SHORT,
+                           datetime.now() + timedelta(minutes=1),
+                           True))
 
                 # plan the execution for the next week
                 schedule_next_execution(user_id=self.user_id,
@@ -635,7 +635,8 @@ class ExecutionRunState(State):
 
     def on_new_day(self, current_date: date):
 
-        quit_date = get_quit_date(self.user_id)
+        plan = get_user_plan(self.user_id)
+        quit_date = plan.quit_date
 
         # in case the current day of the week is the same as the one set in the
         # quit_date (and is not the same date), a new week started.
@@ -653,8 +654,7 @@ class ExecutionRunState(State):
         # completed nor planned, send it now.
 
         # get the date of the previous preferred day
-        last_preferred_day = compute_previous_day(self.user_id, current_date)
-        quit_date = get_quit_date(self.user_id)
+        last_preferred_day = plan.previous_preferred_day(current_date)
 
         # make sure that today is not the preferred day, and that the previous
         # preferred day was in the running phase (i.e., after the quit date )
@@ -678,6 +678,7 @@ class ExecutionRunState(State):
     def run(self):
         logging.info("Running state %s", self.state)
         save_fsm_state_in_db(self.user_id, self.state)
+        refresh_user_plan(self.user_id)
 
         # if the execution week is not 0, it means that we are returning to
         # this state after a relapse, and the week should not be reset.
@@ -800,7 +801,7 @@ class RelapseState(State):
                                        dialog=Components.RELAPSE_DIALOG,
                                        phase_id=3)
 
-            quit_date = get_quit_date(self.user_id)
+            quit_date = refresh_user_plan(self.user_id).quit_date
             current_date = date.today()
 
             # if the quit date is in the future, it has been reset
@@ -839,16 +840,17 @@ class RelapseState(State):
             # get the preferred time of the user and use it. Just add a day otherwise
             _, preferred_time = get_preferred_date_time(self.user_id)
 
-            next_day = datetime.now()
+            next_day = datetime.now(tz=TIMEZONE)
             if preferred_time is not None:
-                next_day.replace(hour=preferred_time.hour, minute=preferred_time.minute)
+                next_day = next_day.replace(hour=preferred_time.hour,
+                                            minute=preferred_time.minute)
 
             next_day += timedelta(days=1)
 
-            self.celery.send_task(RESCHEDULE_DIALOG,
-                                  (self.user_id,
-                                   dialog,
-                                   next_day))
+            send_task(RESCHEDULE_DIALOG,
+                      (self.user_id,
+                       dialog,
+                       next_day))
 
     def on_user_trigger(self, dialog: str):
         if dialog == Components.CONTINUE_UNCOMPLETED_DIALOG:
@@ -1,6 +1,7 @@
 import datetime
 from celery import Celery
 from .const import RESCHEDULE_DIALOG
+from .state_machine_utils import send_task
 
 
 class State:
@@ -55,10 +56,10 @@ class State:
         """
         next_day = datetime.datetime.now() + datetime.timedelta(days=1)
 
-        self.celery.send_task(RESCHEDULE_DIALOG,
-                              (self.user_id,
-                               dialog,
-                               next_day))
+        send_task(RESCHEDULE_DIALOG,
+                  (self.user_id,
+                   dialog,
+                   next_day))
 
     def on_dialog_rescheduled(self, dialog, new_date):  # pylint: disable=unused-argument
         """
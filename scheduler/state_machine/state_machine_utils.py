@@ -1,10 +1,21 @@
+import json
 import logging
-from typing import Optional, List
+import redis
+import time
+import uuid
+from typing import Any, Dict, Iterator, Optional, List, Set, Tuple
 from celery import Celery
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from datetime import datetime, date, timedelta
 from sqlalchemy.exc import NoResultFound
-from state_machine.const import (REDIS_URL, TIMEZONE, TRIGGER_COMPONENT,
-                                 SCHEDULE_TRIGGER_COMPONENT, TRIGGER_INTENT)
+from state_machine.const import (REDIS_URL, TIMEZONE, TRIGGER_COMPONENT, TRIGGER_INTENT,
+                                 SCHEDULED_TASKS_KEY, SCHEDULED_TASKS_PAYLOADS_KEY,
+                                 FSM_CACHE_KEY, FSM_CACHE_EXPIRE, FSM_FENCE_KEY,
+                                 FSM_JOURNAL_KEY, FSM_SNAPSHOT_KEY, FSM_SNAPSHOT_INTERVAL,
+                                 FSM_JOURNAL_MAX_LENGTH, ACTIVITY_C2_9_DAY_TRIGGER,
+                                 TRACKING_DURATION, USER_PLAN_KEY, USER_PLAN_EXPIRE)
 from virtual_coach_db.dbschema.models import (ClosedAnswers, DialogClosedAnswers, DialogQuestions,
                                               InterventionActivitiesPerformed,
                                               InterventionComponents, InterventionPhases, Users,
@@ -14,6 +25,161 @@ from virtual_coach_db.helper.definitions import (Components, ComponentsTriggers,
 from virtual_coach_db.helper.helper_functions import get_db_session
 
 celery = Celery(broker=REDIS_URL)
+redis_client = redis.Redis.from_url(REDIS_URL)
+
+
+@dataclass
+class Outbox:
+    """
+    Side effects emitted while an event of a state machine is handled. They are published
+    only after the state machine has been saved.
+    """
+    # celery tasks to be sent, as (task name, args)
+    tasks: List[Tuple[str, tuple]] = field(default_factory=list)
+    # triggers to be planned in the timer, as (task uuid, user ID, trigger, planned date)
+    timers: List[Tuple[str, int, str, datetime]] = field(default_factory=list)
+    # uuids of the planned tasks to be revoked
+    revoked: List[str] = field(default_factory=list)
+    # fields of the state machines written by the states, by user ID. They are saved together
+    # with the state machine, instead of being written to the DB while the event is handled
+    fsm_writes: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+
+
+class InterventionCatalog:
+    """
+    Snapshot of the static intervention components and phases stored in the DB,
+    indexed by name, trigger and ID.
+    """
+
+    def __init__(self,
+                 components: List[InterventionComponents],
+                 phases: List[InterventionPhases]):
+        self.components_by_name = {component.intervention_component_name: component
+                                   for component in components}
+        self.components_by_id = {component.intervention_component_id: component
+                                 for component in components}
+        # with repeated triggers, the first component is used
+        self.components_by_trigger = {}
+        for component in components:
+            self.components_by_trigger.setdefault(component.intervention_component_trigger,
+                                                  component)
+        self.phases_by_name = {phase.phase_name: phase for phase in phases}
+
+    @classmethod
+    def load(cls) -> 'InterventionCatalog':
+        """
+        Load the intervention components and phases from the DB
+        """
+        session = get_db_session()
+
+        components = (session.query(InterventionComponents)
+                      .order_by(InterventionComponents.intervention_component_id)
+                      .all())
+        phases = session.query(InterventionPhases).all()
+
+        session.expunge_all()
+        session.close()
+
+        return cls(components, phases)
+
+
+# catalog of the current process, loaded at the first use
+intervention_catalog: Optional[InterventionCatalog] = None
+
+
+def get_catalog(refresh: bool = False) -> InterventionCatalog:
+    """
+    Get the catalog of the intervention components and phases, loading it from the DB
+    only the first time or if a refresh is requested
+    Args:
+        refresh: if True, the catalog is loaded again from the DB
+
+    Returns: the catalog
+
+    """
+    global intervention_catalog  # pylint: disable=global-statement
+
+    if intervention_catalog is None or refresh:
+        intervention_catalog = InterventionCatalog.load()
+
+    return intervention_catalog
+
+
+def find_in_catalog(index: str, key: Any) -> Optional[Any]:
+    """
+    Look up a component or a phase in the catalog. If the key is not found, the catalog
+    is refreshed once, in case the DB has been updated after the catalog was loaded.
+    Args:
+        index: the name of the index of InterventionCatalog (e.g., 'components_by_name')
+        key: the name, trigger or ID to be looked up
+
+    Returns: the component or the phase, or None if not found
+
+    """
+    value = getattr(get_catalog(), index).get(key)
+
+    if value is None:
+        value = getattr(get_catalog(refresh=True), index).get(key)
+
+    return value
+
+
+# outbox collecting the side effects of the event being handled, if any
+current_outbox: ContextVar[Optional[Outbox]] = ContextVar('current_outbox', default=None)
+
+
+@contextmanager
+def collect_side_effects() -> Iterator[Outbox]:
+    """
+    Collect in an outbox the tasks sent, planned and revoked through send_task,
+    schedule_trigger and revoke_execution, instead of publishing them immediately.
+    The outbox is published with publish_side_effects.
+    """
+    outbox = Outbox()
+    token = current_outbox.set(outbox)
+    try:
+        yield outbox
+    finally:
+        current_outbox.reset(token)
+
+
+def publish_side_effects(outbox: Outbox):
+    """
+    Publish the side effects collected in an outbox. The tasks are sent through a single
+    broker connection, the triggers are planned with a single redis pipeline and the revokes
+    are sent with a single broadcast.
+    Args:
+        outbox: the outbox to be published
+
+    """
+    if outbox.tasks:
+        with celery.producer_or_acquire() as producer:
+            for name, args in outbox.tasks:
+                celery.send_task(name, args, producer=producer)
+
+    if outbox.timers:
+        add_scheduled_tasks(outbox.timers)
+
+    if outbox.revoked:
+        celery.control.revoke(outbox.revoked)
+        remove_scheduled_task(*outbox.revoked)
+
+
+def send_task(name: str, args: tuple):
+    """
+    Send a celery task, or add it to the outbox if the side effects of an event are
+    being collected
+    Args:
+        name: the name of the task
+        args: the arguments of the task
+
+    """
+    outbox = current_outbox.get()
+
+    if outbox is not None:
+        outbox.tasks.append((name, args))
+    else:
+        celery.send_task(name, args)
 
 
 def compute_next_day(selectable_days: list, current_date: datetime) -> date:
@@ -401,21 +567,7 @@ def get_intervention_component(intervention_component_name: str) -> Intervention
             The intervention component as an InterventionComponents object.
 
     """
-    session = get_db_session()
-
-    selected = (
-        session.query(
-            InterventionComponents
-        )
-        .filter(
-            InterventionComponents.intervention_component_name == intervention_component_name
-        )
-        .one_or_none()
-    )
-    session.expunge(selected)
-    session.close()
-
-    return selected
+    return find_in_catalog('components_by_name', intervention_component_name)
 
 
 def get_hrs_last_branch(user_id: int) -> Optional[Components]:
@@ -552,22 +704,7 @@ def get_phase_object(phase_name: str) -> InterventionPhases:
             The phase as an InterventionPhases object.
 
     """
-    session = get_db_session()
-
-    phases = (
-        session.query(
-            InterventionPhases
-        )
-        .filter(
-            InterventionPhases.phase_name == phase_name
-        )
-        .one_or_none()
-    )
-
-    session.expunge(phases)
-    session.close()
-
-    return phases
+    return find_in_catalog('phases_by_name', phase_name)
 
 
 def get_preferred_date_time(user_id: int) -> tuple:
@@ -765,12 +902,19 @@ def update_execution_week(user_id: int, week_number: int):
 
 def update_fsm_dialog_running_status(user_id: int, dialog_running: bool):
     """
-    Computes the current wek number of the execution phase
+    Set the dialog_running field of the state machine of a user. While an event is handled,
+    the value is saved together with the state machine at the end of the event.
     Args:
         user_id: ID of the user
         dialog_running: value to be set in the dialog_running field of the fsm
 
     """
+    outbox = current_outbox.get()
+
+    if outbox is not None:
+        outbox.fsm_writes.setdefault(user_id, {})['dialog_running'] = dialog_running
+        return
+
     session = get_db_session()
 
     selected = (session.query(UserStateMachine)
@@ -783,6 +927,11 @@ def update_fsm_dialog_running_status(user_id: int, dialog_running: bool):
 
     session.close()
 
+    invalidate_cached_fsm(user_id)
+
+    journal_fsm_write(user_id, 'dialog_running_status', dialog_running,
+                      {'dialog_running': dialog_running})
+
 
 def dialogs_to_be_completed(user_id: int) -> List[UserInterventionState]:
     """
@@ -848,7 +997,7 @@ def run_uncompleted_dialog(user_id: int, dialog_preference: Components = None):
         component.last_time = datetime.now().astimezone(TIMEZONE)
         session.commit()
 
-        celery.send_task(
+        send_task(
             TRIGGER_COMPONENT,
             (user_id, component.intervention_component.intervention_component_trigger)
         )
@@ -891,26 +1040,13 @@ def get_component_id(dialog: Components) -> Optional[int]:
     Args:
         dialog: The component for which to retrieve the ID
     """
-    session = get_db_session()
-
-    intervention_component = (
-        session.query(
-            InterventionComponents
-        )
-        .filter(
-            InterventionComponents.intervention_component_name == dialog.value
-        )
-        .first()
-    )
-
-    user_id = intervention_component.intervention_component_id
-    session.close()
+    intervention_component = find_in_catalog('components_by_name', dialog.value)
 
     if intervention_component is None:
-        logging.error(dialog.value, " not found in the database")
+        logging.error('%s not found in the database', dialog.value)
         return None
 
-    return user_id
+    return intervention_component.intervention_component_id
 
 
 
@@ -923,7 +1059,7 @@ def run_option_menu(user_id: int):
 
     """
 
-    celery.send_task(TRIGGER_INTENT, (user_id, ComponentsTriggers.CENTRAL_OPTIONS, False))
+    send_task(TRIGGER_INTENT, (user_id, ComponentsTriggers.CENTRAL_OPTIONS, False))
 
 
 def retrieve_tracking_day(user_id: int, current_date: date) -> int:
@@ -963,12 +1099,19 @@ def retrieve_tracking_day(user_id: int, current_date: date) -> int:
 
 def save_fsm_state_in_db(user_id: int, state: str):
     """
-    Save the state in the fsm in the db
+    Save the state in the fsm in the db. While an event is handled, the state is saved
+    together with the state machine at the end of the event.
     Args:
         user_id: id of the user
         state: state to be saved
 
     """
+    outbox = current_outbox.get()
+
+    if outbox is not None:
+        outbox.fsm_writes.setdefault(user_id, {})['state'] = state
+        return
+
     session = get_db_session()
 
     user_fsm = (session.query(UserStateMachine)
@@ -984,6 +1127,11 @@ def save_fsm_state_in_db(user_id: int, state: str):
 
     session.close()
 
+    invalidate_cached_fsm(user_id)
+
+    if user_fsm is not None:
+        journal_fsm_write(user_id, 'state', state, {'state': state})
+
 
 def store_rescheduled_dialog(user_id: int,
                              dialog_id: int,
@@ -1013,11 +1161,16 @@ def store_rescheduled_dialog(user_id: int,
                     .filter(UserInterventionState.id == last_state.id)
                     .one())
 
+        old_uuid = selected.task_uuid
         selected.next_planned_date = planned_date
         selected.task_uuid = task_uuid
 
         session.commit()
 
+        # the previous task will not trigger the dialog anymore
+        if old_uuid is not None and old_uuid != task_uuid:
+            remove_scheduled_task(old_uuid)
+
         session.close()
 
 
@@ -1070,7 +1223,7 @@ def store_completed_dialog(user_id: int, dialog: str, phase_id: int):
         # if the user completes a dialog which was scheduled, we don't
         # want that to be re-proposed
         if uuid is not None:
-            celery.control.revoke(uuid)
+            revoke_execution(uuid)
 
     # if for any reason the dialog starting was not recorded in the DB, create the entry
     else:
@@ -1128,7 +1281,7 @@ def plan_and_store(user_id: int,
                    planned_date: Optional[datetime] = None,
                    last_time: Optional[datetime] = None):
     """
-    Program a celery task for the planned_date, or sends it immediately in case
+    Program a trigger in the timer for the planned_date, or sends it immediately in case
     planned_date is None, and stores the new component to the DB
     Args:
         user_id:user id
@@ -1144,22 +1297,20 @@ def plan_and_store(user_id: int,
     trigger = component.intervention_component_trigger
 
     if planned_date is None:
-        celery.send_task(TRIGGER_COMPONENT, (user_id, trigger))
+        send_task(TRIGGER_COMPONENT, (user_id, trigger))
 
         store_scheduled_dialog(user_id=user_id,
                                dialog_id=dialog_id,
                                phase_id=phase_id,
                                last_time=datetime.now().astimezone(TIMEZONE))
     else:
-        task = celery.send_task(SCHEDULE_TRIGGER_COMPONENT,
-                                (user_id, trigger),
-                                eta=planned_date)
+        task_uuid = schedule_trigger(user_id, trigger, planned_date)
 
         store_scheduled_dialog(user_id=user_id,
                                dialog_id=dialog_id,
                                phase_id=phase_id,
                                planned_date=planned_date,
-                               task_uuid=str(task.task_id),
+                               task_uuid=task_uuid,
                                last_time=last_time)
 
 
@@ -1178,19 +1329,61 @@ def plan_every_day_range(user_id: int,
         last_date: last date where the dialog is planned
     """
 
-    for day in range((last_date - first_date).days + 1):
-        planned_date = create_new_date(start_date=first_date,
-                                       time_delta=day)
+    planned_dates = [create_new_date(start_date=first_date, time_delta=day)
+                     for day in range((last_date - first_date).days + 1)]
+
+    plan_and_store_many(user_id=user_id,
+                        phase_id=phase_id,
+                        entries=[(dialog, planned_date) for planned_date in planned_dates])
+
+
+def plan_and_store_many(user_id: int,
+                        phase_id: int,
+                        entries: List[Tuple[str, datetime]]) -> List[str]:
+    """
+    Program several dialogs in the timer and store them to the DB, with a single redis
+    pipeline and a single insert
+    Args:
+        user_id: user id
+        phase_id: db id of the phase
+        entries: list of tuples with the dialog to be triggered and the date when it
+        has to be triggered
+
+    Returns: the uuids of the tasks, in the same order as the entries
+
+    """
+    if not entries:
+        return []
+
+    components = [get_intervention_component(dialog) for dialog, _ in entries]
 
-        plan_and_store(user_id=user_id,
-                       dialog=dialog,
-                       planned_date=planned_date,
-                       phase_id=phase_id)
+    task_uuids = schedule_triggers([(user_id, component.intervention_component_trigger,
+                                     planned_date)
+                                    for component, (_, planned_date) in zip(components, entries)])
+
+    session = get_db_session()
+
+    session.bulk_insert_mappings(UserInterventionState, [
+        {'users_nicedayuid': user_id,
+         'intervention_phase_id': phase_id,
+         'intervention_component_id': component.intervention_component_id,
+         'completed': False,
+         'last_time': None,
+         'last_part': 0,
+         'next_planned_date': planned_date,
+         'task_uuid': task_uuid}
+        for component, (_, planned_date), task_uuid in zip(components, entries, task_uuids)])
+
+    session.commit()
+
+    session.close()
+
+    return task_uuids
 
 
 def reschedule_dialog(user_id: int, dialog: str, planned_date: datetime, phase: int):
     """
-    Program a new celery task for the planned_date and store the info in the db
+    Program a new trigger in the timer for the planned_date and store the info in the db
     Args:
         user_id:user id
         dialog: dialog to be triggered
@@ -1204,15 +1397,13 @@ def reschedule_dialog(user_id: int, dialog: str, planned_date: datetime, phase:
     dialog_id = component.intervention_component_id
     trigger = component.intervention_component_trigger
 
-    task = celery.send_task(SCHEDULE_TRIGGER_COMPONENT,
-                            (user_id, trigger),
-                            eta=planned_date)
+    task_uuid = schedule_trigger(user_id, trigger, planned_date)
 
     store_rescheduled_dialog(user_id=user_id,
                              dialog_id=dialog_id,
                              phase_id=phase,
                              planned_date=planned_date,
-                             task_uuid=str(task.task_id))
+                             task_uuid=task_uuid)
 
 
 def revoke_execution(task_uuid: str):
@@ -1222,7 +1413,404 @@ def revoke_execution(task_uuid: str):
         task_uuid: the uuid of the celery task to be revoked
 
     """
-    celery.control.revoke(task_uuid)
+    outbox = current_outbox.get()
+
+    if outbox is not None:
+        outbox.revoked.append(task_uuid)
+    else:
+        celery.control.revoke(task_uuid)
+        remove_scheduled_task(task_uuid)
+
+
+def schedule_trigger(user_id: int, trigger: str, planned_date: datetime) -> str:
+    """
+    Plan the trigger of an intervention component in the timer. When the planned date is
+    reached, the timer poller releases a trigger_scheduled_intervention_component task with
+    the returned uuid.
+    Args:
+        user_id: the ID of the user to send the trigger to
+        trigger: the intent to be sent
+        planned_date: the time when the trigger has to be sent
+
+    Returns: the uuid of the task
+
+    """
+    return schedule_triggers([(user_id, trigger, planned_date)])[0]
+
+
+def schedule_triggers(triggers: List[Tuple[int, str, datetime]]) -> List[str]:
+    """
+    Plan several triggers in the timer, as schedule_trigger does for one
+    Args:
+        triggers: list of tuples with the user ID, the intent to be sent and the planned date
+
+    Returns: the uuids of the tasks, in the same order as the triggers
+
+    """
+    tasks = [(str(uuid.uuid4()), user_id, trigger, planned_date)
+             for user_id, trigger, planned_date in triggers]
+    outbox = current_outbox.get()
+
+    if outbox is not None:
+        outbox.timers.extend(tasks)
+    else:
+        add_scheduled_tasks(tasks)
+
+    return [task_uuid for task_uuid, _, _, _ in tasks]
+
+
+def add_scheduled_tasks(tasks: List[Tuple[str, int, str, datetime]]):
+    """
+    Plan several triggers in the timer with a single redis pipeline
+    Args:
+        tasks: list of tuples with the task uuid, the user ID, the trigger and the planned date.
+        The naive planned dates are in TIMEZONE, as the ETAs of the celery tasks.
+
+    """
+    pipe = redis_client.pipeline()
+    for task_uuid, user_id, trigger, planned_date in tasks:
+        if planned_date.tzinfo is None:
+            planned_date = planned_date.replace(tzinfo=TIMEZONE)
+
+        pipe.hset(SCHEDULED_TASKS_PAYLOADS_KEY, task_uuid, json.dumps([user_id, trigger]))
+        pipe.zadd(SCHEDULED_TASKS_KEY, {task_uuid: planned_date.timestamp()})
+    pipe.execute()
+
+
+def remove_scheduled_task(*task_uuids: str):
+    """
+    Remove tasks from the timer, once they have been released or revoked
+    Args:
+        task_uuids: the uuids of the celery tasks
+
+    """
+    try:
+        pipe = redis_client.pipeline()
+        pipe.zrem(SCHEDULED_TASKS_KEY, *task_uuids)
+        pipe.hdel(SCHEDULED_TASKS_PAYLOADS_KEY, *task_uuids)
+        pipe.execute()
+    except redis.RedisError as error:
+        logging.warning(f"Tasks {task_uuids} not removed from the scheduled tasks: {error}")
+
+
+def get_scheduled_task_ids() -> Set[str]:
+    """
+    Get the uuids of the tasks planned in the timer, and not yet released
+
+    Returns: the set of the uuids of the scheduled tasks
+
+    """
+    return {task_uuid.decode() for task_uuid in redis_client.zrange(SCHEDULED_TASKS_KEY, 0, -1)}
+
+
+# moves the due tasks forward by the lease time, and returns them with their payloads
+CLAIM_DUE_TASKS_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+if #due == 0 then
+    return {{}, {}}
+end
+for _, task_uuid in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], task_uuid)
+end
+return {due, redis.call('HMGET', KEYS[2], unpack(due))}
+"""
+
+claim_due_tasks_script = redis_client.register_script(CLAIM_DUE_TASKS_SCRIPT)
+
+
+def claim_due_tasks(lease: int, limit: int) -> List[Tuple[str, Optional[int], Optional[str]]]:
+    """
+    Claim the tasks of the timer whose planned time has been reached. The claimed tasks are
+    kept in the timer with their time moved forward by the lease, so that they are claimed
+    again if they are not released before the lease expires.
+    Args:
+        lease: time in seconds before a claimed task can be claimed again
+        limit: maximum number of tasks to be claimed
+
+    Returns: list of tuples with the uuid, the user ID and the trigger of each task. The
+    tasks without user ID and trigger were not planned in the timer (e.g., celery tasks
+    scheduled with an ETA before the timer was introduced).
+
+    """
+    now = time.time()
+    task_uuids, payloads = claim_due_tasks_script(
+        keys=[SCHEDULED_TASKS_KEY, SCHEDULED_TASKS_PAYLOADS_KEY],
+        args=[now, now + lease, limit])
+
+    tasks = []
+    for task_uuid, payload in zip(task_uuids, payloads):
+        user_id, trigger = json.loads(payload) if payload is not None else (None, None)
+        tasks.append((task_uuid.decode(), user_id, trigger))
+
+    return tasks
+
+
+# writes the cached state machine, unless the cached one has a newer version
+SET_CACHED_FSM_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+if cached and cjson.decode(cached)['version'] > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+
+# replaces the cached state machines with tombstones, versioned with the counter of the lock,
+# that the state machines read before the invalidation cannot overwrite
+INVALIDATE_CACHED_FSM_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    local version = redis.call('INCR', KEYS[i + 1])
+    redis.call('SET', KEYS[i], cjson.encode({version = version}), 'EX', ARGV[1])
+end
+return 1
+"""
+
+# appends an entry to the journal of a user's state machine. The entries with the whole state
+# machine are saved as snapshot, at most once every FSM_SNAPSHOT_INTERVAL entries
+APPEND_FSM_JOURNAL_SCRIPT = """
+local entry_id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*',
+                            'event', ARGV[1], 'descriptor', ARGV[2], 'changes', ARGV[3])
+local entries = redis.call('HINCRBY', KEYS[2], 'events', 1)
+if ARGV[6] == '1' then
+    local last = tonumber(redis.call('HGET', KEYS[2], 'snapshot_events') or 0)
+    if last == 0 or entries - last >= tonumber(ARGV[5]) then
+        redis.call('HSET', KEYS[2], 'entry_id', entry_id, 'fsm', ARGV[3],
+                   'snapshot_events', entries)
+    end
+end
+return entry_id
+"""
+
+set_cached_fsm_script = redis_client.register_script(SET_CACHED_FSM_SCRIPT)
+invalidate_cached_fsm_script = redis_client.register_script(INVALIDATE_CACHED_FSM_SCRIPT)
+append_fsm_journal_script = redis_client.register_script(APPEND_FSM_JOURNAL_SCRIPT)
+
+
+def get_cached_fsm(user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Get the cached state machine of a user
+    Args:
+        user_id: ID of the user
+
+    Returns: the serialized state machine, or None if it is not cached or it has been
+    invalidated
+
+    """
+    try:
+        cached = redis_client.get(FSM_CACHE_KEY.format(user_id))
+    except redis.RedisError as error:
+        logging.warning(f"State machine of the user {user_id} not read from the cache: {error}")
+        return None
+
+    if cached is None:
+        return None
+
+    cached = json.loads(cached)
+
+    # the tombstones left by invalidate_cached_fsm only have the version
+    return cached if 'state' in cached else None
+
+
+def set_cached_fsm(user_id: int, fsm: Dict[str, Any], version: int):
+    """
+    Cache the serialized state machine of a user. The cache is updated unless the cached
+    state machine, or the tombstone of an invalidation, is newer than the new one.
+    Args:
+        user_id: ID of the user
+        fsm: the serialized state machine
+        version: the version of the state machine, taken from the counter of the user's lock
+        while holding the lock and before reading (or writing) the state machine in the DB
+
+    """
+    try:
+        set_cached_fsm_script(keys=[FSM_CACHE_KEY.format(user_id)],
+                              args=[json.dumps({**fsm, 'version': version}), version,
+                                    FSM_CACHE_EXPIRE])
+    except redis.RedisError as error:
+        logging.warning(f"State machine of the user {user_id} not cached: {error}")
+
+
+def invalidate_cached_fsm(*user_ids: int):
+    """
+    Invalidate the cached state machines of the users, after they have been changed in the
+    DB without going through the cache. It must be called after the DB commit.
+    Args:
+        user_ids: IDs of the users
+
+    """
+    if not user_ids:
+        return
+
+    keys = []
+    for user_id in user_ids:
+        keys.extend([FSM_CACHE_KEY.format(user_id), FSM_FENCE_KEY.format(user_id)])
+
+    try:
+        invalidate_cached_fsm_script(keys=keys, args=[FSM_CACHE_EXPIRE])
+    except redis.RedisError as error:
+        logging.warning(f"State machines of the users {user_ids} not invalidated in the cache: "
+                        f"{error}")
+
+
+def journal_fsm_write(user_id: int,
+                      event_type: str,
+                      descriptor: Any,
+                      changes: Dict[str, Any],
+                      complete: bool = False):
+    """
+    Append a write of a user's state machine to its journal, after the DB commit. All the
+    writes of the state machines are journaled, so that a state machine can be rebuilt from
+    its last snapshot and the following entries.
+    Args:
+        user_id: ID of the user
+        event_type: the type of the event, or the name of the write
+        descriptor: the descriptor of the event
+        changes: the fields of the serialized state machine written
+        complete: True if changes is the whole serialized state machine, which can be saved
+        as snapshot
+
+    """
+    try:
+        append_fsm_journal_script(keys=[FSM_JOURNAL_KEY.format(user_id),
+                                        FSM_SNAPSHOT_KEY.format(user_id)],
+                                  args=[event_type, json.dumps(descriptor, default=str),
+                                        json.dumps(changes), FSM_JOURNAL_MAX_LENGTH,
+                                        FSM_SNAPSHOT_INTERVAL, int(complete)])
+    except redis.RedisError as error:
+        logging.warning(f'Write {event_type} of the user {user_id} not journaled: {error}')
+
+
+@dataclass
+class UserPlan:
+    """
+    Plan of the intervention of a user, with the dates on which the daily checks of the
+    state machine have to act. It is computed when the user enters a phase and when the
+    quit date changes, so that the daily checks do not query the DB.
+    """
+    start_date: Optional[date] = None
+    quit_date: Optional[date] = None
+    # first day on which the general activity dialog with the activity C2.9 is proposed
+    general_activity_date: Optional[date] = None
+    # first day of the goals setting phase, known once the tracking has started
+    goals_setting_date: Optional[date] = None
+    # preferred day of the week for the weekly reflection (1 is Monday)
+    preferred_day: int = 1
+
+    def is_due(self, milestone: str, current_date: date) -> bool:
+        """
+        Check if the date of a milestone of the plan has been reached
+        Args:
+            milestone: name of the date field of the plan
+            current_date: the current date
+
+        Returns: True if the milestone is planned on or before the current date
+
+        """
+        planned_date = getattr(self, milestone)
+
+        return planned_date is not None and current_date >= planned_date
+
+    def previous_preferred_day(self, current_date: date) -> date:
+        """
+        Get the date of the last preferred day, as in compute_previous_day
+        """
+        return current_date - timedelta(days=(current_date.isoweekday() - self.preferred_day) % 7)
+
+    def to_json(self) -> str:
+        return json.dumps({name: value.isoformat() if isinstance(value, date) else value
+                           for name, value in self.__dict__.items()})
+
+    @classmethod
+    def from_json(cls, serialized: str) -> 'UserPlan':
+        values = json.loads(serialized)
+
+        return cls(**{name: date.fromisoformat(value) if isinstance(value, str) else value
+                      for name, value in values.items()})
+
+
+def compute_user_plan(user_id: int) -> UserPlan:
+    """
+    Compute the plan of the intervention of a user from the DB
+    Args:
+        user_id: ID of the user
+
+    Returns: the plan of the user
+
+    """
+    session = get_db_session()
+
+    user = (session.query(Users)
+            .filter(Users.nicedayuid == user_id)
+            .one())
+    plan = UserPlan(start_date=user.start_date, quit_date=user.quit_date)
+    week_days = user.week_days
+
+    session.close()
+
+    try:
+        plan.preferred_day = int(week_days.split(',')[0])
+    except (AttributeError, ValueError):
+        pass
+
+    if plan.start_date is not None:
+        plan.general_activity_date = plan.start_date + timedelta(days=ACTIVITY_C2_9_DAY_TRIGGER)
+
+    # the goals setting starts at the day TRACKING_DURATION of the tracking, which starts
+    # with the completion of the profile creation (see retrieve_tracking_day)
+    track_dialog = get_last_component_state(user_id,
+                                            get_component_id(Components.PROFILE_CREATION))
+    if track_dialog is not None and track_dialog.completed:
+        tracking_start = track_dialog.last_time
+
+        try:
+            tracking_start = tracking_start.date()
+        except AttributeError:
+            pass
+
+        plan.goals_setting_date = tracking_start + timedelta(days=TRACKING_DURATION - 1)
+
+    return plan
+
+
+def refresh_user_plan(user_id: int) -> UserPlan:
+    """
+    Compute the plan of a user and store it in redis. To be called when the user enters a
+    phase, or when the dates of the plan change.
+    Args:
+        user_id: ID of the user
+
+    Returns: the new plan of the user
+
+    """
+    plan = compute_user_plan(user_id)
+
+    try:
+        redis_client.set(USER_PLAN_KEY.format(user_id), plan.to_json(), ex=USER_PLAN_EXPIRE)
+    except redis.RedisError as error:
+        logging.warning(f"Plan of the user {user_id} not stored: {error}")
+
+    return plan
+
+
+def get_user_plan(user_id: int) -> UserPlan:
+    """
+    Get the plan of a user stored in redis. If it is not available, it is computed again.
+    Args:
+        user_id: ID of the user
+
+    Returns: the plan of the user
+
+    """
+    try:
+        stored = redis_client.get(USER_PLAN_KEY.format(user_id))
+    except redis.RedisError as error:
+        logging.warning(f"Plan of the user {user_id} not read: {error}")
+        return compute_user_plan(user_id)
+
+    if stored is None:
+        return refresh_user_plan(user_id)
+
+    return UserPlan.from_json(stored)
 
 
 def schedule_next_execution(user_id: int, dialog: str, phase_id: int, current_date: datetime):
@@ -0,0 +1,193 @@
+"""
+Telemetry of the celery tasks, collected through the celery signals. For each task name it
+records the time spent in the queue (from the publication, or the ETA, to the start), the run
+time, the retries and the failures, and exposes them on a Prometheus endpoint.
+
+With the prefork pool the tasks run in child processes, so PROMETHEUS_MULTIPROC_DIR must be
+set: the children write the metrics to that directory, and the main process of the worker
+aggregates them when the endpoint is scraped. The directory can be shared by the workers of
+the same host: the first worker exposes the metrics of all of them, and the directory is not
+cleared by the workers, since it would remove the metrics of the other ones.
+"""
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from celery import signals
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Histogram,
+                               multiprocess, start_http_server)
+
+from state_machine.const import TELEMETRY_PORT
+
+PUBLISHED_AT_HEADER = 'published_at'
+
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+queue_wait = Histogram('scheduler_task_queue_wait_seconds',
+                       'Time between the publication (or the ETA) of a task and its start',
+                       ['task'], buckets=TIME_BUCKETS)
+run_time = Histogram('scheduler_task_run_seconds',
+                     'Run time of a task, by final state',
+                     ['task', 'state'], buckets=TIME_BUCKETS)
+retries = Counter('scheduler_task_retries_total',
+                  'Retries of a task, by kind (autoretry or explicit self.retry)',
+                  ['task', 'kind'])
+failures = Counter('scheduler_task_failures_total',
+                   'Failures of a task, by exception',
+                   ['task', 'exception'])
+
+# start time of the tasks running in this process, by task id
+started = {}
+
+
+def get_registry() -> CollectorRegistry:
+    """
+    Get the registry with the metrics of all the worker processes
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+
+    return registry
+
+
+def parse_eta(eta: Any) -> Optional[float]:
+    if eta is None:
+        return None
+
+    if isinstance(eta, datetime):
+        return eta.timestamp()
+
+    try:
+        return datetime.fromisoformat(eta).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+@signals.worker_init.connect
+def start_telemetry_server(**kwargs):  # pylint: disable=unused-argument
+    """
+    Start the Prometheus endpoint in the main process of the worker. If the port is already
+    used by another worker of the same host, that worker exposes the metrics of this one too.
+    """
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+    try:
+        start_http_server(TELEMETRY_PORT, registry=get_registry())
+    except OSError as e:
+        logging.warning(f'Tasks telemetry not exposed on port {TELEMETRY_PORT}: {e}')
+        return
+
+    logging.info(f'Tasks telemetry exposed on port {TELEMETRY_PORT}')
+
+
+@signals.worker_process_shutdown.connect
+def mark_process_dead(pid: int = None, **kwargs):  # pylint: disable=unused-argument
+    # the live gauges of an exited child process are not exposed anymore
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@signals.before_task_publish.connect
+def mark_published(headers: Dict[str, Any] = None, **kwargs):  # pylint: disable=unused-argument
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+@signals.task_prerun.connect
+def on_task_start(task_id: str = None, task=None, **kwargs):  # pylint: disable=unused-argument
+    now = time.time()
+    started[task_id] = time.perf_counter()
+
+    request = task.request
+    published_at = request.get(PUBLISHED_AT_HEADER)
+    if published_at is None:
+        published_at = (request.get('headers') or {}).get(PUBLISHED_AT_HEADER)
+
+    # the tasks planned with an ETA are waiting in the queue only after the ETA
+    due = max(filter(None, (published_at, parse_eta(request.eta))), default=None)
+    if due is not None:
+        queue_wait.labels(task.name).observe(max(now - due, 0))
+
+
+@signals.task_postrun.connect
+def on_task_end(task_id: str = None, task=None, state: str = None,
+                **kwargs):  # pylint: disable=unused-argument
+    start = started.pop(task_id, None)
+    if start is not None:
+        run_time.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - start)
+
+
+@signals.task_retry.connect
+def on_task_retry(sender=None, reason=None, **kwargs):  # pylint: disable=unused-argument
+    # autoretry_for retries pass the exception that caused them to self.retry
+    exc = getattr(reason, 'exc', None)
+    autoretry_for = getattr(sender, 'autoretry_for', ())
+    kind = 'autoretry' if exc is not None and isinstance(exc, autoretry_for) else 'explicit'
+
+    retries.labels(sender.name, kind).inc()
+
+
+@signals.task_failure.connect
+def on_task_failure(sender=None, exception=None, **kwargs):  # pylint: disable=unused-argument
+    failures.labels(sender.name, type(exception).__name__).inc()
+
+
+def summarize() -> Dict[str, Dict[str, float]]:
+    """
+    Aggregate the metrics of all the worker processes by task name
+
+    Returns: dictionary with, for each task, the number of runs, the total and the mean run
+    time, the mean queue wait, the retries by kind and the failures
+
+    """
+    summary = defaultdict(lambda: defaultdict(float))
+
+    for metric in get_registry().collect():
+        for sample in metric.samples:
+            task = sample.labels.get('task')
+            if task is None:
+                continue
+
+            if sample.name == 'scheduler_task_run_seconds_count':
+                summary[task]['runs'] += sample.value
+            elif sample.name == 'scheduler_task_run_seconds_sum':
+                summary[task]['run_seconds'] += sample.value
+            elif sample.name == 'scheduler_task_queue_wait_seconds_count':
+                summary[task]['waits'] += sample.value
+            elif sample.name == 'scheduler_task_queue_wait_seconds_sum':
+                summary[task]['wait_seconds'] += sample.value
+            elif sample.name == 'scheduler_task_retries_total':
+                summary[task][f"{sample.labels['kind']}_retries"] += sample.value
+            elif sample.name == 'scheduler_task_failures_total':
+                summary[task]['failures'] += sample.value
+
+    for values in summary.values():
+        values['mean_run_seconds'] = values['run_seconds'] / values['runs'] if values['runs'] else 0
+        values['mean_wait_seconds'] = (values['wait_seconds'] / values['waits']
+                                       if values['waits'] else 0)
+
+    return summary
+
+
+def log_summary():
+    """
+    Log the telemetry of the tasks, sorted by the total run time
+    """
+    summary = summarize()
+
+    for task, values in sorted(summary.items(), key=lambda item: -item[1]['run_seconds']):
+        logging.info(f"Task {task}: {values['runs']:.0f} runs, "
+                     f"{values['run_seconds']:.1f}s total, "
+                     f"{values['mean_run_seconds']:.3f}s mean run, "
+                     f"{values['mean_wait_seconds']:.3f}s mean queue wait, "
+                     f"{values['autoretry_retries']:.0f} autoretries, "
+                     f"{values['explicit_retries']:.0f} explicit retries, "
+                     f"{values['failures']:.0f} failures")
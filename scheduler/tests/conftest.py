@@ -0,0 +1,9 @@
+import os
+
+# the settings are read when the state machine constants are imported
+for name in ('EXECUTION_DURATION_WEEKS', 'ACTIVITY_C2_9_DAY_TRIGGER', 'FUTURE_SELF_INTRO',
+             'GOAL_SETTING', 'TIME_DELTA_PA_NOTIFICATION', 'TRACKING_DURATION',
+             'PREPARATION_GA', 'MAX_PREPARATION_DURATION'):
+    os.environ.setdefault(name, '1')
+
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
@@ -0,0 +1,29 @@
+"""Unit tests for the timer of the scheduled triggers"""
+from datetime import datetime
+from unittest import mock
+
+from state_machine import state_machine_utils
+from state_machine.const import SCHEDULED_TASKS_KEY, TIMEZONE
+
+
+def planned_timestamp(planned_date: datetime) -> float:
+    with mock.patch.object(state_machine_utils, 'redis_client') as redis_client:
+        state_machine_utils.add_scheduled_tasks([('uuid', 1, 'trigger', planned_date)])
+
+    pipe = redis_client.pipeline.return_value
+    pipe.zadd.assert_called_once_with(SCHEDULED_TASKS_KEY, mock.ANY)
+
+    return pipe.zadd.call_args[0][1]['uuid']
+
+
+def test_naive_planned_date_is_in_the_intervention_timezone():
+    planned_date = datetime(2024, 3, 12, 9, 30)
+
+    assert (planned_timestamp(planned_date)
+            == planned_date.replace(tzinfo=TIMEZONE).timestamp())
+
+
+def test_aware_planned_date_is_kept():
+    planned_date = datetime(2024, 3, 12, 9, 30, tzinfo=TIMEZONE)
+
+    assert planned_timestamp(planned_date) == planned_date.timestamp()
@@ -0,0 +1,133 @@
+"""
+Benchmarks of the sensorapi connector against the fake sensors API.
+
+Example:
+    python -m benchmarks.benchmark_connector --users 200 --latency 0.05
+
+The fake server is started in the same process. If REDIS_URL is set, the connector uses the
+local stores of the daily data, and the repeated calls are served from Redis.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from benchmarks.fake_server import FixturesSource, HISTORY_DAYS, TABLES, start_server
+
+
+def create_private_key(directory: str) -> str:
+    """
+    Create a private key in the OpenSSH format used by the connector to sign the tokens.
+
+    Returns: the path of the key
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = os.path.join(directory, 'sensorprivatekey')
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.OpenSSH,
+                                  serialization.NoEncryption()))
+
+    return path
+
+
+def run_case(function: Callable[[int], object], user_ids: List[int]) -> Dict[str, float]:
+    """
+    Call the function once for each user, and collect the timings in milliseconds.
+    """
+    timings = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        function(user_id)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+
+    return {'mean': statistics.mean(timings),
+            'p50': timings[len(timings) // 2],
+            'p95': timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+            'total': sum(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the sensorapi connector')
+    parser.add_argument('--users', type=int, default=200, help='number of users per case')
+    parser.add_argument('--days', type=int, default=HISTORY_DAYS,
+                        help='days of history per user')
+    parser.add_argument('--fixtures', default=None,
+                        help='directory with the recorded fixtures')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay in seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random delay in seconds added to the latency')
+    args = parser.parse_args()
+
+    source = FixturesSource(args.fixtures, args.users, args.days, cache_size=2 * args.users)
+    # the payloads are generated before the benchmark, so that only the connector is measured
+    for user_id in range(args.users):
+        for table in TABLES:
+            source.get_records(table, user_id)
+
+    server, url = start_server(source, latency=args.latency, jitter=args.jitter)
+
+    # the URL of the API is read when the connector is imported
+    os.environ['SENSOR_API_DEV'] = url
+    os.environ['ENVIRONMENT'] = 'dev'
+    from sensorapi import connector  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as directory:
+        connector.SENSOR_KEY_PATH = create_private_key(directory)
+
+        user_ids = list(range(args.users))
+        end = datetime.now()
+
+        def steps_goals(user_id: int):
+            start = end - timedelta(days=connector.STEP_GOALS_DAYS)
+            steps_data = connector.get_steps_data(user_id, start, end)
+            connector.get_step_goals_and_steps(steps_data, start, end)
+
+        cases = {
+            'get_steps_data (7 days)':
+                lambda user_id: connector.get_steps_data(user_id, end - timedelta(days=7), end),
+            'get_steps_data (full history)':
+                connector.get_steps_data,
+            'get_steps_arrays (full history)':
+                connector.get_steps_arrays,
+            'get_intensity_minutes_data (7 days)':
+                lambda user_id: connector.get_intensity_minutes_data(
+                    user_id, end - timedelta(days=7), end),
+            'get_intensity_minutes_data (28 days)':
+                lambda user_id: connector.get_intensity_minutes_data(
+                    user_id, end - timedelta(days=28), end),
+            'get_steps_data + get_step_goals_and_steps':
+                steps_goals,
+            'get_daily_step_goal':
+                connector.get_daily_step_goal,
+        }
+
+        # the steps goals computation alone, on prefetched data
+        start = end - timedelta(days=connector.STEP_GOALS_DAYS)
+        steps_data = {user_id: connector.get_steps_data(user_id, start, end)
+                      for user_id in user_ids}
+        cases['get_step_goals_and_steps (computation)'] = \
+            lambda user_id: connector.get_step_goals_and_steps(steps_data[user_id], start, end)
+
+        print(f'{args.users} users, {args.days} days of history, latency {args.latency}s, '
+              f"store {'enabled' if connector.steps_store is not None else 'disabled'}")
+        print(f"{'case':<45}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}")
+        for name, function in cases.items():
+            result = run_case(function, user_ids)
+            print(f"{name:<45}{result['mean']:>10.2f}{result['p50']:>10.2f}"
+                  f"{result['p95']:>10.2f}{result['total'] / 1000:>10.2f}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
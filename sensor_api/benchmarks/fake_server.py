@@ -0,0 +1,265 @@
+"""
+Local stand-in for the sensors API, serving the steps and heart rate tables of synthetic users,
+so that sensorapi can be exercised and benchmarked without the real endpoints.
+
+Example:
+    python -m benchmarks.fake_server --port 8081 --users 5000 --latency 0.2
+
+and then set SENSOR_API_DEV=http://localhost:8081/ for the connector.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+import numpy as np
+
+STEPS_TABLE = 'garmin_steps_day'
+HR_TABLE = 'garmin_heart_history'
+TABLES = (STEPS_TABLE, HR_TABLE)
+TOKEN_HEADER = 'X-PerfectFit-Auth-Token'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000'
+
+# number of days of data generated for each user
+HISTORY_DAYS = 120
+# number of generated users whose payloads are kept in memory
+PAYLOAD_CACHE_SIZE = 256
+
+
+class FixturesSource:
+    """
+    Source of the records of the sensors tables. The records are read from a fixtures directory,
+    containing a file <table>/<user_id>.json for each recorded response of the sensors API.
+    The users without a recorded file get deterministic synthetic data, generated from their ID.
+    """
+
+    def __init__(self, fixtures_dir: Optional[str] = None,
+                 num_users: int = 5000,
+                 history_days: int = HISTORY_DAYS,
+                 last_day: Optional[date] = None,
+                 cache_size: int = PAYLOAD_CACHE_SIZE):
+        self.fixtures_dir = fixtures_dir
+        self.num_users = num_users
+        self.history_days = history_days
+        self.last_day = last_day if last_day is not None else date.today()
+
+        self.get_records = lru_cache(maxsize=cache_size)(self._get_records)
+
+    def _get_records(self, table: str, user_id: int) -> Optional[List[Dict[str, Any]]]:
+        if self.fixtures_dir is not None:
+            path = os.path.join(self.fixtures_dir, table, f'{user_id}.json')
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+
+        if not 0 <= user_id < self.num_users:
+            return None
+
+        if table == STEPS_TABLE:
+            return generate_steps_records(user_id, self.last_day, self.history_days)
+
+        return generate_heart_records(user_id, self.last_day, self.history_days)
+
+    def save(self, fixtures_dir: str, user_ids: List[int]):
+        """
+        Write the records of the users to a fixtures directory.
+        Args:
+            fixtures_dir: the directory where the fixtures are saved
+            user_ids: the IDs of the users to be saved
+        """
+        for table in TABLES:
+            os.makedirs(os.path.join(fixtures_dir, table), exist_ok=True)
+            for user_id in user_ids:
+                records = self.get_records(table, user_id)
+                if records is None:
+                    continue
+                with open(os.path.join(fixtures_dir, table, f'{user_id}.json'), 'w',
+                          encoding='utf-8') as f:
+                    json.dump(records, f)
+
+
+def generate_steps_records(user_id: int, last_day: date, days: int) -> List[Dict[str, Any]]:
+    """
+    Generate the daily steps of a user, with a user-specific average and some days without data.
+    """
+    rng = np.random.default_rng(user_id)
+    average = rng.uniform(2000, 12000)
+    steps = rng.normal(average, average / 3, days).clip(0).astype(int)
+    worn = rng.random(days) > 0.1
+
+    first_day = last_day - timedelta(days=days - 1)
+
+    return [{'localTime': (first_day + timedelta(days=i)).strftime(TIME_FORMAT),
+             'value': int(steps[i])}
+            for i in range(days) if worn[i]]
+
+
+def generate_heart_records(user_id: int, last_day: date, days: int) -> List[Dict[str, Any]]:
+    """
+    Generate the hourly heart rate records of a user, with one value per minute and a few
+    active hours per day.
+    """
+    rng = np.random.default_rng(user_id + 1_000_000)
+    hours = days * 24
+    rest = rng.uniform(55, 80)
+    values = rng.normal(rest, 8, (hours, 60))
+    active = rng.random(hours) < 0.08
+    values[active] += rng.uniform(30, 70, (int(active.sum()), 1))
+    values = values.clip(40, 200).astype(int)
+    worn = rng.random(hours) > 0.15
+
+    first_day = last_day - timedelta(days=days - 1)
+
+    return [{'localTime': (first_day + timedelta(hours=i)).strftime(TIME_FORMAT),
+             'values': values[i].tolist()}
+            for i in range(hours) if worn[i]]
+
+
+def filter_records(records: List[Dict[str, Any]],
+                   start: Optional[str],
+                   end: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    Select the records in the range [start, end). Without a range, all the records are returned.
+    """
+    if start is None or end is None:
+        return records
+
+    return [record for record in records if start <= record['localTime'][:10] < end]
+
+
+class FakeSensorsHandler(BaseHTTPRequestHandler):
+    """
+    Request handler serving GET /table/<table>?start=<date>&end=<date>. The user is
+    identified by the subject of the JWT token, whose signature is not verified.
+    """
+
+    source: FixturesSource
+    latency: float
+    jitter: float
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        table = url.path.rstrip('/').rsplit('/', 1)[-1]
+        if table not in TABLES:
+            self.send_error(404, f'Unknown table {table}')
+            return
+
+        user_id = self.get_user_id()
+        if user_id is None:
+            self.send_error(401, 'Missing or invalid token')
+            return
+
+        records = self.source.get_records(table, user_id)
+        if records is None:
+            self.send_error(404, f'Unknown user {user_id}')
+            return
+
+        params = parse_qs(url.query)
+        start = params.get('start', [None])[0]
+        end = params.get('end', [None])[0]
+        body = json.dumps(filter_records(records, start, end)).encode()
+
+        delay = self.latency + (np.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_user_id(self) -> Optional[int]:
+        token = self.headers.get(TOKEN_HEADER)
+        if token is None:
+            return None
+
+        try:
+            payload = jwt.decode(token, options={'verify_signature': False})
+            return int(payload['sub'])
+        except (jwt.PyJWTError, KeyError, ValueError):
+            return None
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug(format, *args)
+
+
+def create_server(source: FixturesSource,
+                  host: str = 'localhost',
+                  port: int = 0,
+                  latency: float = 0.0,
+                  jitter: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Create the fake sensors API server.
+    Args:
+        source: the source of the served records
+        host: the host to bind
+        port: the port to bind. With 0, a free port is chosen
+        latency: delay (in seconds) added to every response
+        jitter: maximum random delay (in seconds) added on top of the latency
+
+    Returns: the server, not started yet
+    """
+    handler = type('Handler', (FakeSensorsHandler,),
+                   {'source': source, 'latency': latency, 'jitter': jitter})
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_server(source: FixturesSource, **kwargs) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start the fake sensors API server in a background thread.
+
+    Returns: the server and its base URL, to be used as SENSOR_API_DEV
+    """
+    server = create_server(source, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    host, port = server.server_address[:2]
+
+    return server, f'http://{host}:{port}/'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake sensors API')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=5000,
+                        help='number of synthetic users (IDs from 0)')
+    parser.add_argument('--days', type=int, default=HISTORY_DAYS,
+                        help='days of synthetic history per user')
+    parser.add_argument('--fixtures', default=None,
+                        help='directory with the recorded fixtures')
+    parser.add_argument('--save-fixtures', type=int, default=0, metavar='N',
+                        help='save the fixtures of the first N users to --fixtures and exit')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay in seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random delay in seconds added to the latency')
+    args = parser.parse_args()
+
+    source = FixturesSource(args.fixtures, args.users, args.days)
+
+    if args.save_fixtures:
+        if args.fixtures is None:
+            parser.error('--save-fixtures requires --fixtures')
+        source.save(args.fixtures, list(range(args.save_fixtures)))
+        return
+
+    server = create_server(source, args.host, args.port, args.latency, args.jitter)
+    logging.info(f'Fake sensors API listening on http://{args.host}:{args.port}/')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
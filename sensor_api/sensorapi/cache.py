@@ -0,0 +1,462 @@
+import json
+import logging
+import os
+import redis
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+# number of days after which the value of a day is stored permanently
+FINAL_AFTER_DAYS = int(os.getenv('SENSORS_FINAL_AFTER_DAYS', '2'))
+# the watch can be synchronized some days late. The stored days younger than this are
+# requested again to the sensors API every REVALIDATE_INTERVAL seconds
+REVALIDATE_DAYS = int(os.getenv('SENSORS_REVALIDATE_DAYS', '7'))
+# the days without data are not final, and are requested again every REVALIDATE_INTERVAL
+# seconds until they are older than this
+MISSING_DAYS_WINDOW = int(os.getenv('SENSORS_MISSING_DAYS_WINDOW', '30'))
+REVALIDATE_INTERVAL = int(os.getenv('SENSORS_REVALIDATE_INTERVAL', str(6 * 60 * 60)))
+# time (in seconds) for which the values of the days that are not final yet (e.g., today)
+# are reused before querying the sensors API again
+RECENT_TTL = int(os.getenv('SENSORS_RECENT_TTL', '300'))
+# maximum age (in seconds) of the values of the days that are not final yet that can still be
+# served while they are refreshed in the background
+STALE_BUDGET = int(os.getenv('SENSORS_STALE_BUDGET', '900'))
+# maximum time (in seconds) for a background refresh, after which another one can be started
+REFRESH_LOCK_TIME = 60
+# time (in seconds) for which the step goals precomputed for a day are kept
+STEP_GOALS_TTL = 2 * 24 * 60 * 60
+
+# background refreshes of the recent values
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='sensorapi-refresh')
+
+KEY_PREFIX = 'sensorapi'
+COVERAGE_FIELD = '_coverage'
+REVALIDATED_FIELD = '_revalidated'
+DATE_FORMAT = '%Y-%m-%d'
+
+# function querying the sensors API for a range of days [start, end). If both start and end are
+# None, the full history is requested. It returns None in case of errors.
+FetchFunction = Callable[[Optional[date], Optional[date]], Optional[Dict[date, Any]]]
+
+
+class DailySeriesStore:
+    """
+    Per-user store of daily values retrieved from the sensors API.
+
+    The final days are saved in a Redis hash per user, together with the interval of days
+    that has already been retrieved, so that only the missing days are requested to the API.
+    Since the watch can be synchronized late, the stored days of the last REVALIDATE_DAYS days
+    and the days without data of the last MISSING_DAYS_WINDOW days are requested again every
+    REVALIDATE_INTERVAL seconds.
+    The days that are not final yet are cached for RECENT_TTL seconds. After that, and up to
+    STALE_BUDGET seconds, the last known values are served while they are refreshed in the
+    background, so that a slow sensors API does not block the callers.
+    """
+
+    def __init__(self, name: str,
+                 client: redis.Redis,
+                 final_after_days: int = FINAL_AFTER_DAYS,
+                 recent_ttl: int = RECENT_TTL,
+                 stale_budget: int = STALE_BUDGET,
+                 revalidate_days: int = REVALIDATE_DAYS,
+                 missing_days_window: int = MISSING_DAYS_WINDOW,
+                 revalidate_interval: int = REVALIDATE_INTERVAL):
+        self.name = name
+        self.client = client
+        self.final_after_days = final_after_days
+        self.recent_ttl = recent_ttl
+        self.stale_budget = max(stale_budget, recent_ttl)
+        self.revalidate_days = revalidate_days
+        self.missing_days_window = missing_days_window
+        self.revalidate_interval = revalidate_interval
+
+    def get_range(self, user_id: int,
+                  start: Optional[date],
+                  end: Optional[date],
+                  fetch: FetchFunction) -> Optional[Dict[date, Any]]:
+        """
+        Get the daily values of a user in the range [start, end), querying the
+        sensors API only for the days that are not available in the store.
+        Args:
+            user_id: ID of the user
+            start: first day of the range. If start or end is None, the full history is returned
+            end: end of the range. This day is not included
+            fetch: function querying the sensors API for a range of days
+
+        Returns: a dictionary with the date as key and the value of the day as value.
+        None if the data could not be retrieved from the sensors API.
+        """
+        try:
+            return self._get_range(user_id, start, end, fetch)
+        except redis.RedisError as error:
+            logging.warning(f"Sensors data store not available, querying the API: {error}")
+            if start is None or end is None:
+                return fetch(None, None)
+            return fetch(start, end)
+
+    def _get_range(self, user_id: int,
+                   start: Optional[date],
+                   end: Optional[date],
+                   fetch: FetchFunction) -> Optional[Dict[date, Any]]:
+        today = date.today()
+        # the days before final_end are stored permanently
+        final_end = today - timedelta(days=self.final_after_days)
+        # the stored days that can still be synchronized late
+        recheck_start = today - timedelta(days=max(self.revalidate_days,
+                                                   self.missing_days_window))
+        recheck_days = [recheck_start + timedelta(days=i)
+                        for i in range(max((final_end - recheck_start).days, 0))]
+
+        pipe = self.client.pipeline()
+        pipe.hmget(self._key(user_id),
+                   [COVERAGE_FIELD, REVALIDATED_FIELD]
+                   + [day.strftime(DATE_FORMAT) for day in recheck_days])
+        pipe.get(self._recent_key(user_id))
+        (coverage_raw, revalidated_raw, *recheck_values), recent_raw = pipe.execute()
+
+        coverage = decode_coverage(coverage_raw)
+
+        if start is None or end is None:
+            # the full history can be served from the store only if it has been
+            # entirely retrieved at least once
+            if coverage is None or not coverage[2]:
+                return self._fetch_full_history(user_id, final_end, fetch)
+            start, end = coverage[0], today + timedelta(days=1)
+
+        intervals = []
+
+        # final days not present in the store. The stored interval is kept contiguous
+        final_stop = min(end, final_end)
+        if start < final_stop:
+            if coverage is None:
+                intervals.append((start, final_stop))
+            else:
+                if start < coverage[0]:
+                    intervals.append((start, coverage[0]))
+                if final_stop > coverage[1]:
+                    intervals.append((coverage[1], final_stop))
+
+        revalidated = (coverage is not None
+                       and time.time() - float(revalidated_raw or 0) > self.revalidate_interval)
+        if revalidated:
+            intervals.extend(self._recheck_intervals(today, coverage, recheck_days,
+                                                     recheck_values))
+
+        # days not final yet. They are reused only if they have been retrieved recently
+        recent = None
+        recent_start = max(start, final_end)
+        if recent_start < end:
+            recent_end = max(end, today + timedelta(days=1))
+            cached = decode_recent(recent_raw, recent_start, end)
+
+            if cached is not None:
+                recent, fetched_at = cached
+                age = time.time() - fetched_at
+                if age > self.stale_budget:
+                    recent = None
+                elif age > self.recent_ttl:
+                    # serve the last known values, and refresh them in the background
+                    self._refresh_recent(user_id, final_end, recent_end, fetch)
+
+            if recent is None:
+                intervals.append((final_end, recent_end))
+
+        fetched = {}
+        for interval_start, interval_end in merge_intervals(intervals):
+            values = fetch(interval_start, interval_end)
+            if values is None:
+                return None
+            fetched.update(values)
+
+        if intervals:
+            # on the first retrieval all the stored days are new
+            self._store(user_id, fetched, intervals, coverage, final_end,
+                        revalidated=revalidated or coverage is None)
+
+        result = {}
+        if start < final_stop:
+            days = [start + timedelta(days=i) for i in range((final_stop - start).days)]
+            stored = self.client.hmget(self._key(user_id),
+                                       [day.strftime(DATE_FORMAT) for day in days])
+            for day, value in zip(days, stored):
+                if day in fetched:
+                    result[day] = fetched[day]
+                elif value is not None:
+                    result[day] = json.loads(value)
+
+        if recent_start < end:
+            if recent is None:
+                recent = {day: value for day, value in fetched.items() if day >= final_end}
+            result.update({day: value for day, value in recent.items()
+                           if recent_start <= day < end})
+
+        return dict(sorted(result.items()))
+
+    def _recheck_intervals(self, today: date,
+                           coverage: Tuple[date, date, bool],
+                           days: List[date],
+                           stored: List[Optional[bytes]]) -> List[Tuple[date, date]]:
+        """
+        Get the intervals of stored days to be requested again: the days of the last
+        revalidate_days days, and the days without data of the last missing_days_window days.
+        """
+        revalidate_start = today - timedelta(days=self.revalidate_days)
+        missing_start = today - timedelta(days=self.missing_days_window)
+
+        intervals = []
+        for day, value in zip(days, stored):
+            if not coverage[0] <= day < coverage[1]:
+                continue
+            if day >= revalidate_start or (value is None and day >= missing_start):
+                intervals.append((day, day + timedelta(days=1)))
+
+        return merge_intervals(intervals)
+
+    def _refresh_recent(self, user_id: int, start: date, end: date, fetch: FetchFunction):
+        """
+        Refresh the values of the days that are not final yet in a background thread.
+        Only one refresh per user is running at the same time.
+        """
+        if self.client.set(self._refresh_key(user_id), 1, nx=True, ex=REFRESH_LOCK_TIME):
+            refresh_executor.submit(self._refresh, user_id, start, end, fetch)
+
+    def _refresh(self, user_id: int, start: date, end: date, fetch: FetchFunction):
+        try:
+            values = fetch(start, end)
+            if values is not None:
+                # all the refreshed days are recent, so the first one is used as final end
+                self._store(user_id, values, [(start, end)], None, start)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(f"Error while refreshing the sensors data of user {user_id}")
+        finally:
+            try:
+                self.client.delete(self._refresh_key(user_id))
+            except redis.RedisError:
+                pass
+
+    def _fetch_full_history(self, user_id: int,
+                            final_end: date,
+                            fetch: FetchFunction) -> Optional[Dict[date, Any]]:
+        values = fetch(None, None)
+        if values is None:
+            return None
+
+        first = min([final_end] + list(values))
+        self._store(user_id, values, [(first, date.today() + timedelta(days=1))], None,
+                    final_end, full=True, revalidated=True)
+
+        return dict(sorted(values.items()))
+
+    def _store(self, user_id: int,  # pylint: disable=too-many-arguments
+               values: Dict[date, Any],
+               intervals: List[Tuple[date, date]],
+               coverage: Optional[Tuple[date, date, bool]],
+               final_end: date,
+               full: bool = False,
+               revalidated: bool = False):
+        """
+        Save the retrieved values, splitting the final days from the recent ones,
+        and extend the stored interval of final days. If the days that can still be
+        synchronized late have been requested again, the time of the revalidation is saved.
+        """
+        final_intervals = [(a, min(b, final_end)) for a, b in intervals if a < final_end]
+        recent_intervals = [(max(a, final_end), b) for a, b in intervals if b > final_end]
+
+        mapping = {day.strftime(DATE_FORMAT): json.dumps(value)
+                   for day, value in values.items() if day < final_end}
+
+        if final_intervals or full:
+            first = min((a for a, _ in final_intervals), default=final_end)
+            last = max((b for _, b in final_intervals), default=final_end)
+            if coverage is not None:
+                first = min(first, coverage[0])
+                last = max(last, coverage[1])
+                full = full or coverage[2]
+            mapping[COVERAGE_FIELD] = encode_coverage((first, last, full))
+
+        if revalidated:
+            mapping[REVALIDATED_FIELD] = time.time()
+
+        try:
+            pipe = self.client.pipeline()
+            if mapping:
+                pipe.hset(self._key(user_id), mapping=mapping)
+            if recent_intervals:
+                recent = {'start': min(a for a, _ in recent_intervals).strftime(DATE_FORMAT),
+                          'end': max(b for _, b in recent_intervals).strftime(DATE_FORMAT),
+                          'fetched_at': time.time(),
+                          'values': {day.strftime(DATE_FORMAT): value
+                                     for day, value in values.items() if day >= final_end}}
+                pipe.set(self._recent_key(user_id), json.dumps(recent), ex=self.stale_budget)
+            pipe.execute()
+        except redis.RedisError as error:
+            logging.warning(f"Sensors data could not be stored: {error}")
+
+    def invalidate(self, user_id: int):
+        """
+        Remove all the stored values of a user.
+        Args:
+            user_id: ID of the user
+        """
+        self.client.delete(self._key(user_id), self._recent_key(user_id))
+
+    def _key(self, user_id: int) -> str:
+        return f'{KEY_PREFIX}:{self.name}:{user_id}'
+
+    def _recent_key(self, user_id: int) -> str:
+        return f'{KEY_PREFIX}:{self.name}:{user_id}:recent'
+
+    def _refresh_key(self, user_id: int) -> str:
+        return f'{KEY_PREFIX}:{self.name}:{user_id}:refresh'
+
+
+class StepGoalsStore:
+    """
+    Store of the step goals precomputed every night for all the users.
+
+    The goals of a day are saved in a Redis hash, with the user ID as field, so that
+    the goals of a user can be read with a single lookup.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int = STEP_GOALS_TTL):
+        self.client = client
+        self.ttl = ttl
+
+    def save(self, day: date, goals: Dict[int, Dict[str, Any]]):
+        """
+        Save the step goals of the users for a day.
+        Args:
+            day: the day the goals refer to
+            goals: dictionary with the user ID as key and the goals of the user as value
+        """
+        if not goals:
+            return
+
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(day),
+                  mapping={str(user_id): json.dumps(value) for user_id, value in goals.items()})
+        pipe.expire(self._key(day), self.ttl)
+        pipe.execute()
+
+    def get(self, user_id: int, day: date) -> Optional[Dict[str, Any]]:
+        """
+        Get the step goals of a user precomputed for a day.
+        Args:
+            user_id: ID of the user
+            day: the day the goals refer to
+
+        Returns: the goals of the user, or None if they have not been precomputed
+        """
+        try:
+            raw = self.client.hget(self._key(day), str(user_id))
+        except redis.RedisError as error:
+            logging.warning(f"Step goals store not available: {error}")
+            return None
+
+        if raw is None:
+            return None
+
+        return json.loads(raw)
+
+    @staticmethod
+    def _key(day: date) -> str:
+        return f'{KEY_PREFIX}:step_goals:{day.strftime(DATE_FORMAT)}'
+
+
+def get_daily_series_store(name: str, **settings: int) -> Optional[DailySeriesStore]:
+    """
+    Create the store for a daily series of sensors data.
+    Args:
+        name: name of the series (e.g., steps)
+        settings: settings of the store different from the defaults (e.g., missing_days_window)
+
+    Returns: the DailySeriesStore, or None if no Redis URL is configured.
+    In that case, all the data are requested to the sensors API.
+    """
+    if REDIS_URL is None:
+        return None
+
+    return DailySeriesStore(name, redis.Redis.from_url(REDIS_URL), **settings)
+
+
+def get_step_goals_store() -> Optional[StepGoalsStore]:
+    """
+    Create the store of the precomputed step goals.
+
+    Returns: the StepGoalsStore, or None if no Redis URL is configured.
+    In that case, the goals are always computed when requested.
+    """
+    if REDIS_URL is None:
+        return None
+
+    return StepGoalsStore(redis.Redis.from_url(REDIS_URL))
+
+
+def merge_intervals(intervals: List[Tuple[date, date]]) -> List[Tuple[date, date]]:
+    """
+    Merge the overlapping or adjacent intervals of days, so that they can be
+    retrieved with a single query.
+    Args:
+        intervals: list of intervals [start, end)
+
+    Returns: the sorted list of merged intervals
+    """
+    merged = []
+    for interval_start, interval_end in sorted(intervals):
+        if merged and interval_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], interval_end))
+        else:
+            merged.append((interval_start, interval_end))
+
+    return merged
+
+
+def encode_coverage(coverage: Tuple[date, date, bool]) -> str:
+    first, last, full = coverage
+    return f'{first.strftime(DATE_FORMAT)}|{last.strftime(DATE_FORMAT)}|{int(full)}'
+
+
+def decode_coverage(raw: Optional[bytes]) -> Optional[Tuple[date, date, bool]]:
+    """
+    Decode the interval of final days saved in the store.
+    Args:
+        raw: the value stored in Redis
+
+    Returns: a tuple with the first day, the end of the interval (not included), and
+    a flag indicating whether the interval starts at the beginning of the user's history.
+    """
+    if raw is None:
+        return None
+
+    first, last, full = raw.decode().split('|')
+
+    return date.fromisoformat(first), date.fromisoformat(last), full == '1'
+
+
+def decode_recent(raw: Optional[bytes],
+                  start: date,
+                  end: date) -> Optional[Tuple[Dict[date, Any], float]]:
+    """
+    Decode the recent values saved in the store, if they cover the range [start, end).
+    Args:
+        raw: the value stored in Redis
+        start: first day needed
+        end: end of the range needed (not included)
+
+    Returns: the recent values and the time when they were retrieved, or None if they are not
+    available for the whole range
+    """
+    if raw is None:
+        return None
+
+    recent = json.loads(raw)
+    if (date.fromisoformat(recent['start']) > start
+            or date.fromisoformat(recent['end']) < end):
+        return None
+
+    values = {date.fromisoformat(day): value for day, value in recent['values'].items()}
+
+    return values, recent.get('fetched_at', 0)
@@ -2,14 +2,20 @@ import jwt
 import logging
 import os
 import requests
-import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, date, datetime
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
+from sensorapi.cache import get_daily_series_store, get_step_goals_store
+from sensorapi.resilience import CircuitBreaker
+from sensorapi.stream import iter_json_array
+
 # dev or prod environment
 ENVIRONMENT = os.getenv('ENVIRONMENT')
 SENSOR_API_PROD = os.getenv('SENSOR_API_PROD')
@@ -26,11 +32,36 @@ else:
 STEPS_URL = API_URL + 'table/garmin_steps_day'
 HR_URL = API_URL + 'table/garmin_heart_history'
 HR_INTENSITY_THRESHOLD = 110
+# size in bytes of the chunks in which the heart rate data are read
+HR_CHUNK_SIZE = 64 * 1024
 MIN_VALUE_STEP_GOAL = 2000
 MAX_VALUE_STEP_GOAL = 10000
+# the step goal is the 60th percentile (6th lowest value) of the steps of the previous 9 days
+STEP_GOAL_WINDOW = 9
+STEP_GOAL_RANK = 5
+NUM_STEP_GOALS = 7
+# days of steps needed for the goals of the last 7 days
+STEP_GOALS_DAYS = NUM_STEP_GOALS + STEP_GOAL_WINDOW
 TOKEN_HEADER = 'X-PerfectFit-Auth-Token'
+# timeout (in seconds) of the requests to the sensors API
+REQUEST_TIMEOUT = int(os.getenv('SENSORS_REQUEST_TIMEOUT', '60'))
+# number of users whose data are requested in parallel to the sensors API
+FETCH_WORKERS = int(os.getenv('SENSORS_FETCH_WORKERS', '16'))
 PA_LAPSE_MODERATION = 0.95
 MAX_VALUE_INTENSITY_GOAL = 150
+# days for which the days without heart rate data are requested again, as the watch can be
+# synchronized late. The heart rate payloads are large, and only the last week is used
+HR_MISSING_DAYS_WINDOW = int(os.getenv('SENSORS_HR_MISSING_DAYS_WINDOW', '14'))
+
+# local stores of the daily steps and intensity minutes. None if no Redis instance is configured
+steps_store = get_daily_series_store('steps')
+intensity_minutes_store = get_daily_series_store('intensity_minutes',
+                                                 missing_days_window=HR_MISSING_DAYS_WINDOW)
+# step goals precomputed every night. None if no Redis instance is configured
+step_goals_store = get_step_goals_store()
+
+# after repeated failures, the requests to the sensors API fail immediately
+sensors_circuit = CircuitBreaker('sensors API')
 
 
 # functions for sensors data querying
@@ -44,10 +75,7 @@ def get_jwt_token(user_id: int) -> str:
 
     """
 
-    with open(SENSOR_KEY_PATH, 'rb') as f:
-        private_key = serialization.load_ssh_private_key(
-            f.read(), password=None, backend=default_backend()
-        )
+    private_key = load_private_key(SENSOR_KEY_PATH)
 
     encoded = jwt.encode({"sub": user_id, "iat": int(round(datetime.now().timestamp()))},
                          private_key, algorithm="RS256")
@@ -55,12 +83,30 @@ def get_jwt_token(user_id: int) -> str:
     return str(encoded)
 
 
+@lru_cache(maxsize=1)
+def load_private_key(key_path: str):
+    """
+    Load the private key used to sign the JWT tokens. Loading and validating the key takes
+    much longer than signing a token, so the key is loaded only once.
+    Args:
+        key_path: path of the private key file
+
+    Returns: the private key
+    """
+    with open(key_path, 'rb') as f:
+        return serialization.load_ssh_private_key(
+            f.read(), password=None, backend=default_backend()
+        )
+
+
 # functions for sensors data querying
 def get_steps_data(user_id: int,
                    start_date: Optional[date] = None,
                    end_date: Optional[date] = None) -> Optional[List[Dict[Any, Any]]]:
     """
-    Get the steps data of a user in the specified time interval.
+    Get the steps data of a user in the specified time interval. The days already retrieved are
+    served from the local steps store, and only the missing or not yet final days are
+    requested to the sensors API.
     Args:
         user_id (int): ID of the user whom data needs to be queried.
         start_date (Optional[date]): start of the range of days to query. This day is  included in
@@ -72,28 +118,223 @@ def get_steps_data(user_id: int,
     start or end date is specified, it will return all available step data.
     """
 
+    steps_per_day = get_steps_per_day(user_id, start_date, end_date)
+
+    if steps_per_day is None:
+        return []
+
+    return [{'date': day, 'steps': steps} for day, steps in steps_per_day.items()]
+
+
+def get_steps_arrays(user_id: int,
+                     start_date: Optional[date] = None,
+                     end_date: Optional[date] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the steps data of a user in the specified time interval, as two arrays instead of a list
+    of dictionaries. This avoids creating an object per day, e.g., for the full history.
+    Args:
+        user_id (int): ID of the user whom data needs to be queried.
+        start_date (Optional[date]): start of the range of days to query. This day is  included in
+                                     the interval.
+        end_date (Optional[date]): end of the range of days to query. This day is not included in
+                                   the interval.
+
+    Returns: A datetime64[D] array with the sorted dates, and an int32 array with the number of
+    steps of each date. If no start or end date is specified, it will return all available
+    step data. Both arrays are empty if no data are available.
+    """
+    if steps_store is None:
+        steps_arrays = query_steps_arrays(user_id, *steps_range(start_date, end_date))
+        if steps_arrays is None:
+            return np.array([], dtype='datetime64[D]'), np.array([], dtype=np.int32)
+        return steps_arrays
+
+    steps_per_day = get_steps_per_day(user_id, start_date, end_date)
+    if steps_per_day is None:
+        steps_per_day = {}
+
+    dates = np.array(list(steps_per_day.keys()), dtype='datetime64[D]')
+    steps = np.nan_to_num(np.array(list(steps_per_day.values()), dtype=np.float64))
+
+    return dates, steps.astype(np.int32)
+
+
+def get_steps_per_day(user_id: int,
+                      start_date: Optional[date] = None,
+                      end_date: Optional[date] = None) -> Optional[Dict[date, int]]:
+    """
+    Get the steps data of a user in the specified time interval, using the local steps store
+    if available.
+
+    Returns: A dictionary with the date as key and the number of steps as value, sorted by date.
+    None in case of errors.
+    """
+    start_date, end_date = steps_range(start_date, end_date)
+
+    def fetch(start: Optional[date], end: Optional[date]) -> Optional[Dict[date, int]]:
+        return query_steps_data(user_id, start, end)
+
+    if steps_store is not None:
+        return steps_store.get_range(user_id, start_date, end_date, fetch)
+
+    return fetch(start_date, end_date)
+
+
+def get_steps_per_day_of_users(user_ids: List[int],
+                               start_date: date,
+                               end_date: date,
+                               workers: int = FETCH_WORKERS) -> List[Optional[Dict[date, int]]]:
+    """
+    Get the steps data of several users in the specified time interval, requesting them in
+    parallel. An error for a user is logged, and does not stop the retrieval for the others.
+    Args:
+        user_ids (List[int]): IDs of the users whom data need to be queried.
+        start_date (date): start of the range of days to query. This day is included.
+        end_date (date): end of the range of days to query. This day is not included.
+        workers (int): number of users whose data are requested in parallel.
+
+    Returns: For each user, a dictionary with the date as key and the number of steps as value,
+    or None if the data could not be retrieved.
+    """
+    def fetch(user_id: int) -> Optional[Dict[date, int]]:
+        try:
+            return get_steps_per_day(user_id, start_date, end_date)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(f"Error while retrieving the steps data of user {user_id}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, user_ids))
+
+
+def steps_range(start_date: Optional[date],
+                end_date: Optional[date]) -> Tuple[Optional[date], Optional[date]]:
+    """
+    Normalize the range of days to query. If the start or the end is missing,
+    the full history is queried, and both are None.
+    """
+    if start_date is not None and end_date is not None:
+        return to_date(start_date), to_date(end_date)
+
+    return None, None
+
+
+def query_steps_data(user_id: int,
+                     start_date: Optional[date] = None,
+                     end_date: Optional[date] = None) -> Optional[Dict[date, int]]:
+    """
+    Query the sensors API for the steps data of a user in the specified time interval.
+    Args:
+        user_id (int): ID of the user whom data needs to be queried.
+        start_date (Optional[date]): start of the range of days to query. This day is  included in
+                                     the interval.
+        end_date (Optional[date]): end of the range of days to query. This day is not included in
+                                   the interval.
+
+    Returns: A dictionary with the date as key and the number of steps as value. If no start
+    or end date is specified, it will return all available step data. None in case of errors.
+    """
+    steps_arrays = query_steps_arrays(user_id, start_date, end_date)
+    if steps_arrays is None:
+        return None
+
+    dates, steps = steps_arrays
+
+    return dict(zip(dates.astype(date).tolist(), steps.tolist()))
+
+
+def query_steps_arrays(user_id: int,
+                       start_date: Optional[date] = None,
+                       end_date: Optional[date] = None) -> Optional[Tuple[np.ndarray,
+                                                                           np.ndarray]]:
+    """
+    Query the sensors API for the steps data of a user in the specified time interval, and decode
+    them to a datetime64[D] array of dates and an int32 array of steps.
+    Args:
+        user_id (int): ID of the user whom data needs to be queried.
+        start_date (Optional[date]): start of the range of days to query. This day is  included in
+                                     the interval.
+        end_date (Optional[date]): end of the range of days to query. This day is not included in
+                                   the interval.
+
+    Returns: The sorted dates and the number of steps of each date. Missing values are set to 0,
+    and if a date is returned more than once, the last value is used. If no start
+    or end date is specified, it will return all available step data. None in case of errors.
+    """
+
     token = get_jwt_token(user_id)
     headers = {TOKEN_HEADER: token}
 
     if start_date is not None and end_date is not None:
         query_params = {'start': start_date.strftime("%Y-%m-%d"),
                         'end': end_date.strftime("%Y-%m-%d")}
-
-        res = requests.get(STEPS_URL, params=query_params, headers=headers, timeout=60)
-
     else:
-        res = requests.get(STEPS_URL, headers=headers, timeout=60)
+        query_params = None
+
+    res = request_sensors_api(STEPS_URL, query_params, headers)
+    if res is None:
+        return None
 
     try:
         res_json = res.json()
-        mapped_results = [{'date': format_sensors_date(day['localTime']), 'steps': day['value']}
-                          for day in res_json]
+        dates = parse_sensors_dates([day['localTime'] for day in res_json])
+        steps = np.array([day['value'] for day in res_json], dtype=np.float64)
 
-        return mapped_results
+        return sort_daily_arrays(dates, np.nan_to_num(steps).astype(np.int32))
 
-    except ValueError:
+    except (ValueError, KeyError, TypeError):
         logging.error(f"Error in returned value from sensors: '{res}'")
-        return []
+        return None
+
+
+def to_date(value: date) -> date:
+    """
+    Convert a datetime to a date. Date objects are returned unchanged.
+    Args:
+        value: the date or datetime to be converted
+
+    Returns: The date.
+
+    """
+    if isinstance(value, datetime):
+        return value.date()
+
+    return value
+
+
+def parse_sensors_dates(sensors_dates: List[str]) -> np.ndarray:
+    """
+    Convert the times returned by the sensors data into a datetime64[D] array. The times have the
+    fixed format '%Y-%m-%dT%H:%M:%S.%f', so only the first 10 characters, containing the date,
+    are parsed. This is much faster than parsing each time with strptime.
+    Args:
+        sensors_dates: time values returned by sensors' data.
+
+    Returns: The array of dates.
+
+    Raises: ValueError if a date is not valid
+    """
+    return np.array(sensors_dates, dtype='U10').astype('datetime64[D]')
+
+
+def sort_daily_arrays(dates: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sort the daily values by date. If a date is present more than once, only its last value
+    is kept.
+    Args:
+        dates: the datetime64[D] array with the dates
+        values: the array with the value of each date
+
+    Returns: The sorted dates without duplicates, and the corresponding values.
+    """
+    order = np.argsort(dates, kind='stable')
+    dates = dates[order]
+    values = values[order]
+
+    last = np.ones(len(dates), dtype=bool)
+    last[:-1] = dates[1:] != dates[:-1]
+
+    return dates[last], values[last]
 
 
 def format_sensors_date(sensors_date: str) -> date:
@@ -118,6 +359,10 @@ def get_intensity_minutes_data(user_id: int,
                                end_date: date) -> Optional[int]:
     """
     Retrieves the intensity minutes data for a specific user within a given date range.
+    The intensity minutes of the days already retrieved are served from the local store,
+    and only the missing or not yet final days are requested to the sensors API. The days
+    without heart rate data are not final, and are requested again for HR_MISSING_DAYS_WINDOW
+    days.
 
     Args:
         user_id (int): The ID of the user.
@@ -129,28 +374,136 @@ def get_intensity_minutes_data(user_id: int,
         date range. Returns None if there was an error in retrieving or processing the data.
     """
 
-    token = get_jwt_token(user_id)
+    start_date = to_date(start_date)
+    end_date = to_date(end_date)
+
+    def fetch(start: Optional[date], end: Optional[date]) -> Optional[Dict[date, int]]:
+        return query_intensity_minutes_data(user_id, start, end)
+
+    if intensity_minutes_store is not None:
+        minutes_per_day = intensity_minutes_store.get_range(user_id, start_date, end_date, fetch)
+    else:
+        minutes_per_day = fetch(start_date, end_date)
+
+    if minutes_per_day is None:
+        return None
+
+    intensity_minutes = sum(minutes_per_day.values())
+
+    return min(intensity_minutes, MAX_VALUE_INTENSITY_GOAL)
 
-    query_params = {'start': start_date.strftime("%Y-%m-%d"),
-                    'end': end_date.strftime("%Y-%m-%d")}
+
+def query_intensity_minutes_data(user_id: int,
+                                 start_date: Optional[date] = None,
+                                 end_date: Optional[date] = None) -> Optional[Dict[date, int]]:
+    """
+    Query the sensors API for the heart rate data of a user, and count the intensity minutes
+    of each day. The response is processed while it is downloaded, so that the whole payload
+    is never kept in memory.
+
+    Args:
+        user_id (int): The ID of the user.
+        start_date (Optional[date]): The start date of the data range.
+        end_date (Optional[date]): The end date of the data range. This day is not included.
+
+    Returns:
+        Optional[Dict[date, int]]: The number of intensity minutes of each day with heart rate
+        data. Returns None if there was an error in retrieving or processing the data.
+    """
+
+    token = get_jwt_token(user_id)
 
     headers = {TOKEN_HEADER: token}
 
-    res = requests.get(HR_URL, params=query_params, headers=headers, timeout=60)
+    if start_date is not None and end_date is not None:
+        query_params = {'start': start_date.strftime("%Y-%m-%d"),
+                        'end': end_date.strftime("%Y-%m-%d")}
+    else:
+        query_params = None
 
-    try:
-        res_json = res.json()
-        intensity_minutes = 0
-        for hour in res_json:
-            intensity_minutes += sum(val > HR_INTENSITY_THRESHOLD for val in hour['values'])
+    res = request_sensors_api(HR_URL, query_params, headers, stream=True)
+    if res is None:
+        return None
 
-        return min(intensity_minutes, MAX_VALUE_INTENSITY_GOAL)
+    with res:
+        try:
+            hours = iter_json_array(res.iter_content(chunk_size=HR_CHUNK_SIZE))
+            return count_intensity_minutes_per_day(hours)
 
+        except requests.RequestException as error:
+            # the connection failed while the data were downloaded
+            sensors_circuit.record_failure()
+            logging.error(f"Error in the request to the sensors API: {error}")
+            return None
 
-    except ValueError:
-        logging.error(f"Error in returned value from sensors: '{res}'")
+        except (ValueError, KeyError, TypeError):
+            logging.error(f"Error in returned value from sensors: '{res}'")
+            return None
+
+
+def request_sensors_api(url: str,
+                        params: Optional[Dict[str, str]],
+                        headers: Dict[str, str],
+                        stream: bool = False) -> Optional[requests.Response]:
+    """
+    Send a GET request to the sensors API, going through the circuit breaker. If the API failed
+    repeatedly, the request is not sent and None is returned immediately.
+
+    Args:
+        url (str): the URL of the table to query.
+        params (Optional[Dict[str, str]]): the query parameters.
+        headers (Dict[str, str]): the request headers.
+        stream (bool): if True, the content of the response is downloaded while it is read.
+
+    Returns:
+        Optional[requests.Response]: the response, or None if the request failed, the API
+        returned a server error, or the request was not sent.
+    """
+
+    if not sensors_circuit.allow_request():
+        logging.warning(f"Sensors API not available, request to '{url}' not sent")
         return None
 
+    try:
+        res = requests.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT,
+                           stream=stream)
+    except requests.RequestException as error:
+        sensors_circuit.record_failure()
+        logging.error(f"Error in the request to the sensors API: {error}")
+        return None
+
+    if res.status_code >= 500:
+        sensors_circuit.record_failure()
+        logging.error(f"Error in the request to the sensors API: status {res.status_code}")
+        res.close()
+        return None
+
+    sensors_circuit.record_success()
+
+    return res
+
+
+def count_intensity_minutes_per_day(hours: Iterable[Dict[str, Any]]) -> Dict[date, int]:
+    """
+    Fold the hourly heart rate samples into the number of intensity minutes of each day,
+    i.e., the number of samples above HR_INTENSITY_THRESHOLD.
+
+    Args:
+        hours: the hourly heart rate records, containing the 'localTime' and the 'values'.
+
+    Returns:
+        The number of intensity minutes of each day.
+    """
+    minutes_per_day = {}
+
+    for hour in hours:
+        day = date.fromisoformat(hour['localTime'][:10])
+        values = np.asarray(hour['values'], dtype=np.float64)
+        minutes = int(np.count_nonzero(values > HR_INTENSITY_THRESHOLD))
+        minutes_per_day[day] = minutes_per_day.get(day, 0) + minutes
+
+    return minutes_per_day
+
 
 def get_step_goals_and_steps(steps_data: Optional[List[Dict[Any, Any]]],
                              start: datetime,
@@ -182,52 +535,179 @@ def get_step_goals_and_steps(steps_data: Optional[List[Dict[Any, Any]]],
     if len(steps_data) == 0:  # No data is returned from db
         return None, None, None, None
 
-    df = pd.DataFrame(steps_data)
-    df.set_index('date', inplace=True)
+    dates, steps = steps_data_to_array(steps_data, start, end)
+
+    step_goals, actual_steps, goals_achieved = compute_step_goals_and_steps(steps)
+
+    # Get list with dates
+    dutch_date_list = format_dutch_dates(dates[-NUM_STEP_GOALS:])
+    return step_goals.tolist(), actual_steps.tolist(), dutch_date_list, int(goals_achieved)
+
+
+def get_weekly_step_goals(user_id: int) -> Tuple[Optional[List[int]],
+                                                 Optional[List[int]],
+                                                 Optional[List[str]],
+                                                 Optional[int]]:
+    """
+    Get the step goals of the last 7 days of a user, the actual steps of those days, their dates
+    and the number of days that the goal was achieved, as returned by get_step_goals_and_steps
+    for the 16 days before today. The values precomputed during the night are used if available.
+
+    Args:
+        user_id (int): the ID of the user
+
+    Returns:
+        goals (list): the step goals of the last 7 days
+        actual_steps (list): the steps of the last 7 days
+        date_list (list): the dates of the last 7 days
+        goals_achieved (int): number of days that the step goals were reached
+    """
+    if step_goals_store is not None:
+        goals = step_goals_store.get(user_id, date.today())
+        if goals is not None:
+            return goals['goals'], goals['steps'], goals['dates'], goals['goals_achieved']
+
+    end = datetime.now()
+    start = end - timedelta(days=STEP_GOALS_DAYS)
+    steps_data = get_steps_data(user_id=user_id, start_date=start, end_date=end)
+
+    return get_step_goals_and_steps(steps_data, start, end)
+
 
-    # Check whether the first expected date is present
-    if df.index.min().strftime('%y%m%d') != start.strftime('%y%m%d'):
-        df.loc[start.date()] = 0
+def format_dutch_dates(dates: np.ndarray) -> List[str]:
+    """
+    Format the dates as shown to the users, e.g., 'Ma 05'.
 
-    # Check whether last expected date is present
-    end_date = end - timedelta(days=1)  # -1 day, because the end date is not returned from the API
-    if df.index.max().strftime('%y%m%d') != end_date.strftime('%y%m%d'):
-        df.loc[end_date.date()] = 0
+    Args:
+        dates (np.ndarray): the datetime64[D] array with the dates.
 
-    # Resample the data to a day-to-day basis. Add zeros for empty dates
-    df = df.asfreq('D', fill_value=0)
+    Returns:
+        The list of formatted dates.
+    """
+    dutch_day_abbreviations = ['Ma', 'Di', 'Wo', 'Do', 'Vr', 'Za', 'Zo']
+    return [f"{dutch_day_abbreviations[day.weekday()]} {day.strftime('%d')}"
+            for day in dates.astype(date)]
+
+
+def steps_data_to_array(steps_data: List[Dict[Any, Any]],
+                        start: date,
+                        end: date) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert the steps data to an array with one value per day, going from the start date
+    to the day before the end date. Missing days are set to 0.
+
+    Args:
+        steps_data (list): List of dictionaries containing 'date' and 'steps' data.
+        start (date): Start date of the desired range.
+        end (date): End date of the desired range. This day is not included.
+
+    Returns:
+        dates (np.ndarray): the datetime64[D] array with the dates.
+        steps (np.ndarray): the float array with the steps of each date.
+    """
+    data_dates = np.array([to_date(day['date']) for day in steps_data], dtype='datetime64[D]')
+    data_steps = np.array([day['steps'] for day in steps_data], dtype=np.float64)
+
+    # days out of the requested range extend the array, as for the resampled data
+    first = min(np.datetime64(to_date(start), 'D'), data_dates.min())
+    last = max(np.datetime64(to_date(end), 'D') - 1, data_dates.max())
+
+    dates = np.arange(first, last + 1, dtype='datetime64[D]')
+    steps = np.zeros(len(dates), dtype=np.float64)
+    steps[(data_dates - first).astype(np.int64)] = np.nan_to_num(data_steps)
+
+    return dates, steps
+
+
+def stack_steps_data(steps_data_list: List[List[Dict[Any, Any]]],
+                     start: date,
+                     end: date) -> np.ndarray:
+    """
+    Convert the steps data of several users to a users x days array, going from the start date
+    to the day before the end date. Missing days are set to 0, and the days out of the
+    range are discarded.
+
+    Args:
+        steps_data_list (list): the steps data of each user, as returned by get_steps_data.
+        start (date): Start date of the desired range.
+        end (date): End date of the desired range. This day is not included.
+
+    Returns:
+        The float array with shape (users, days).
+    """
+    first = np.datetime64(to_date(start), 'D')
+    num_days = int((np.datetime64(to_date(end), 'D') - first).astype(np.int64))
 
-    # Calculate the step goals
-    steps = list(df.steps)
-    step_goals = []
-    for i in range(7):
-        steps_nine_days = steps[i:i + 9]
-        steps_nine_days = [x for x in steps_nine_days if not pd.isna(x)]  # Remove NaN values
+    steps = np.zeros((len(steps_data_list), num_days), dtype=np.float64)
 
-        if not steps_nine_days:
-            step_goals.append(MIN_VALUE_STEP_GOAL)
+    for user_index, steps_data in enumerate(steps_data_list):
+        if not steps_data:
+            continue
+        days = (np.array([to_date(day['date']) for day in steps_data], dtype='datetime64[D]')
+                - first).astype(np.int64)
+        values = np.nan_to_num(np.array([day['steps'] for day in steps_data], dtype=np.float64))
+        in_range = (days >= 0) & (days < num_days)
+        steps[user_index, days[in_range]] = values[in_range]
 
-        else:
-            for _ in range(9 - len(steps_nine_days)):
-                steps_nine_days.append(0)  # Add 0 up to 9 values
+    return steps
 
-            steps_nine_days.sort()
-            step_goals.append(int(round(steps_nine_days[5], -1)))  # Definition of the goal
+
+def compute_step_goals(steps: np.ndarray, num_goals: int = NUM_STEP_GOALS) -> np.ndarray:
+    """
+    Compute consecutive step goals from the daily steps of a single user or of a whole cohort.
+    The goal i is the 60th percentile (the 6th lowest value) of the steps of the days from i to
+    i + 8, where missing days count as 0. Goals are rounded to tens and limited between
+    MIN_VALUE_STEP_GOAL and MAX_VALUE_STEP_GOAL.
+
+    Args:
+        steps (np.ndarray): the daily steps, with shape (days,) for a single user or
+                            (users, days) for a cohort. NaN values count as 0.
+        num_goals (int): the number of consecutive goals to compute.
+
+    Returns:
+        The integer array of goals, with shape (num_goals,) or (users, num_goals).
+    """
+    steps = np.nan_to_num(np.asarray(steps, dtype=np.float64))
+
+    # days needed to compute all the goals. Missing days at the end are added as 0
+    num_days = num_goals + STEP_GOAL_WINDOW - 1
+    padding = [(0, 0)] * (steps.ndim - 1) + [(0, max(num_days - steps.shape[-1], 0))]
+    steps = np.pad(steps, padding)[..., :num_days]
+
+    windows = sliding_window_view(steps, STEP_GOAL_WINDOW, axis=-1)
+    goals = np.partition(windows, STEP_GOAL_RANK, axis=-1)[..., STEP_GOAL_RANK]
 
     # Minimum goal is 2000, max is 10.000 steps/per day.
-    step_goals = min_max_step_goal(step_goals)
+    goals = np.clip(np.round(goals, -1), MIN_VALUE_STEP_GOAL, MAX_VALUE_STEP_GOAL)
+
+    return goals.astype(np.int64)
+
+
+def compute_step_goals_and_steps(steps: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the step goals of the last 7 days, the actual steps of those days and the number
+    of days that the goal was achieved, for a single user or a whole cohort.
+
+    Args:
+        steps (np.ndarray): the daily steps, with shape (days,) for a single user or
+                            (users, days) for a cohort. The goal of each of the last 7 days
+                            is computed on the 9 days before it, so 16 days are expected.
+
+    Returns:
+        goals (np.ndarray): the step goals, with shape (7,) or (users, 7).
+        actual_steps (np.ndarray): the steps of the last 7 days, with shape (7,) or (users, 7).
+        goals_achieved (np.ndarray): the number of days that the step goals were reached,
+                                     with shape () or (users,).
+    """
+    steps = np.nan_to_num(np.asarray(steps, dtype=np.float64))
 
-    actual_steps = [int(x) if not np.isnan(x) else 0 for x in steps[-7:]]
+    step_goals = compute_step_goals(steps)
+    actual_steps = steps[..., -NUM_STEP_GOALS:].astype(np.int64)
 
     # Calculate number of days goal is achieved
-    goals_achieved = sum(np.array(step_goals)*PA_LAPSE_MODERATION < np.array(actual_steps))
+    goals_achieved = np.sum(step_goals * PA_LAPSE_MODERATION < actual_steps, axis=-1)
 
-    # Get list with dates
-    dutch_day_abbreviations = ['Ma', 'Di', 'Wo', 'Do', 'Vr', 'Za', 'Zo']
-    last_7_dates = df.index[-7:]
-    dutch_date_list = [f"{dutch_day_abbreviations[date.weekday()]} {date.strftime('%d')}" for date
-                       in last_7_dates]
-    return step_goals, actual_steps, dutch_date_list, goals_achieved
+    return step_goals, actual_steps, goals_achieved
 
 
 def get_daily_step_goal(user_id) -> Optional[int]:
@@ -247,27 +727,82 @@ def get_daily_step_goal(user_id) -> Optional[int]:
     Returns:
     int: The daily step goal for the given user, retrieved from the database.
     """
-    steps_per_day = []
+    if step_goals_store is not None:
+        goals = step_goals_store.get(user_id, date.today())
+        if goals is not None and goals['daily_goal'] is not None:
+            return goals['daily_goal']
 
     end = datetime.now()
-    start = end - timedelta(days=9)
+    start = end - timedelta(days=STEP_GOAL_WINDOW)
     steps_data = get_steps_data(user_id=user_id, start_date=start, end_date=end)
 
     if len(steps_data) == 0:  # do something if steps_data is empty
         return None
 
-    for day in steps_data:
-        steps_per_day.append(day['steps'])
+    steps_per_day = np.array([day['steps'] for day in steps_data], dtype=np.float64)
+
+    # Min value 2000, max value 10.000
+    pa_goal = compute_step_goals(steps_per_day, num_goals=1)[0]
+    return int(pa_goal)
 
-    for _ in range(9 - len(steps_per_day)):
-        steps_per_day.append(0)  # Add with 0 to total 9 values
 
-    steps_per_day.sort()
-    pa_goal = int(round(steps_per_day[5], -1))
+def store_step_goals(user_ids: List[int],
+                     current_date: Optional[date] = None) -> Tuple[int, List[int]]:
+    """
+    Compute the daily step goal, the step goals of the last 7 days and the number of days
+    that the goals were achieved for all the users at once, and save them in the step goals
+    store. They are then used by get_daily_step_goal and get_weekly_step_goals.
+    The steps of the users are requested in parallel. Users without steps data, or whose
+    data could not be retrieved, are not saved, so that their goals are computed when requested.
 
-    # Min value 2000, max value 10.000
-    pa_goal = min_max_step_goal(pa_goal)
-    return pa_goal
+    Args:
+        user_ids (list): the IDs of the users
+        current_date (date): the day the goals are computed for. Defaults to today
+
+    Returns:
+        The number of users whose goals have been saved, and the IDs of the users whose
+        steps data could not be retrieved.
+    """
+    if step_goals_store is None:
+        logging.warning("No step goals store configured, the goals are not precomputed")
+        return 0, []
+
+    if current_date is None:
+        current_date = date.today()
+
+    start = current_date - timedelta(days=STEP_GOALS_DAYS)
+    steps_per_user = get_steps_per_day_of_users(user_ids, start, current_date)
+
+    failed = [user_id for user_id, steps_per_day in zip(user_ids, steps_per_user)
+              if steps_per_day is None]
+    steps_data_list = [[{'date': day, 'steps': steps} for day, steps in
+                        (steps_per_day or {}).items()]
+                       for steps_per_day in steps_per_user]
+
+    steps = stack_steps_data(steps_data_list, start, current_date)
+    step_goals, actual_steps, goals_achieved = compute_step_goals_and_steps(steps)
+    daily_goals = compute_step_goals(steps[:, -STEP_GOAL_WINDOW:], num_goals=1)[:, 0]
+
+    # same checks on the available data as get_daily_step_goal and get_step_goals_and_steps
+    daily_start = current_date - timedelta(days=STEP_GOAL_WINDOW)
+    dates = format_dutch_dates(np.arange(np.datetime64(start, 'D') + STEP_GOAL_WINDOW,
+                                         np.datetime64(current_date, 'D')))
+
+    goals = {}
+    for index, (user_id, steps_data) in enumerate(zip(user_ids, steps_data_list)):
+        if not steps_data:
+            continue
+
+        has_daily_data = any(daily_start <= to_date(day['date']) for day in steps_data)
+        goals[user_id] = {'daily_goal': int(daily_goals[index]) if has_daily_data else None,
+                          'goals': step_goals[index].tolist(),
+                          'steps': actual_steps[index].tolist(),
+                          'dates': dates,
+                          'goals_achieved': int(goals_achieved[index])}
+
+    step_goals_store.save(current_date, goals)
+
+    return len(goals), failed
 
 
 def min_max_step_goal(step_goal):
@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import time
+
+# number of consecutive failed requests after which the circuit opens
+BREAKER_FAILURES = int(os.getenv('SENSORS_BREAKER_FAILURES', '3'))
+# time (in seconds) after which a request is tried again once the circuit is open
+BREAKER_RESET_TIME = int(os.getenv('SENSORS_BREAKER_RESET_TIME', '60'))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the requests to the sensors API.
+
+    After failure_threshold consecutive failures the circuit opens, and the requests fail
+    immediately instead of waiting for the API. After reset_time seconds a single trial
+    request is let through: the circuit closes if it succeeds, and opens again otherwise.
+    """
+
+    def __init__(self, name: str,
+                 failure_threshold: int = BREAKER_FAILURES,
+                 reset_time: int = BREAKER_RESET_TIME):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def allow_request(self) -> bool:
+        """
+        Check whether a request can be sent.
+
+        Returns: True if the circuit is closed or a trial request can be sent, False otherwise
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if (not self._trial_running
+                    and time.monotonic() - self._opened_at >= self.reset_time):
+                self._trial_running = True
+                return True
+
+            return False
+
+    def record_success(self):
+        """
+        Record a successful request, closing the circuit.
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit '{self.name}' closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """
+        Record a failed request, opening the circuit if the failures threshold is reached.
+        """
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning(f"Circuit '{self.name}' opened after "
+                                    f"{self._failures} failures")
+                self._opened_at = time.monotonic()
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
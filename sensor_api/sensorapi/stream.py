@@ -0,0 +1,89 @@
+import codecs
+import json
+from typing import Any, Iterable, Iterator, Union
+
+WHITESPACE = ' \t\n\r'
+SEPARATORS = WHITESPACE + ',]'
+
+
+def iter_json_array(chunks: Iterable[Union[bytes, str]]) -> Iterator[Any]:
+    """
+    Decode a JSON array incrementally, yielding each element as soon as it has been read.
+    Only the element being decoded is kept in memory, so that large responses of the
+    sensors API can be processed while they are downloaded.
+    Args:
+        chunks: the content of the JSON array, e.g., as returned by requests' iter_content
+
+    Returns: an iterator over the elements of the array
+
+    Raises: ValueError if the content is not a valid JSON array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+
+    buffer = ''
+    position = 0
+    exhausted = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, exhausted
+        if exhausted:
+            return False
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            text = text_decoder.decode(b'', final=True)
+        elif isinstance(chunk, bytes):
+            text = text_decoder.decode(chunk)
+        else:
+            text = chunk
+
+        # drop the content that has already been decoded
+        buffer = buffer[position:] + text
+        position = 0
+        return True
+
+    def next_char() -> str:
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                raise ValueError('Unexpected end of the JSON array')
+
+    if next_char() != '[':
+        raise ValueError('The content is not a JSON array')
+    position += 1
+
+    if next_char() == ']':
+        return
+
+    while True:
+        next_char()
+
+        # a value is complete only if it is followed by a separator, otherwise
+        # it might continue in the next chunk (e.g., a number)
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not read_more():
+                    raise
+                continue
+
+            if (end < len(buffer) and buffer[end] in SEPARATORS) or not read_more():
+                break
+
+        position = end
+        yield value
+
+        separator = next_char()
+        position += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"Unexpected character '{separator}' in the JSON array")
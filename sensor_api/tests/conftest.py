@@ -0,0 +1,4 @@
+import os
+
+# the URL of the sensors API is read when the connector is imported
+os.environ.setdefault('SENSOR_API_DEV', 'http://localhost:8081/')
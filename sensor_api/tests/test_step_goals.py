@@ -0,0 +1,175 @@
+"""
+Equivalence of the NumPy step goals engine with the previous pandas implementation
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sensorapi.connector import (MAX_VALUE_STEP_GOAL, MIN_VALUE_STEP_GOAL, NUM_STEP_GOALS,
+                                 PA_LAPSE_MODERATION, STEP_GOAL_WINDOW, compute_step_goals,
+                                 get_step_goals_and_steps)
+
+END = datetime(2024, 3, 20, 10, 30)
+# days of steps data needed for the step goals
+STEP_GOALS_DAYS = NUM_STEP_GOALS + STEP_GOAL_WINDOW
+
+
+def pandas_step_goals_and_steps(steps_data: List[Dict[Any, Any]], start: datetime,
+                                end: datetime):
+    """
+    get_step_goals_and_steps as implemented with pandas
+    """
+    if len(steps_data) == 0:
+        return None, None, None, None
+
+    df = pd.DataFrame(steps_data)
+    # asfreq needs a DatetimeIndex
+    df['date'] = pd.to_datetime(df['date'])
+    df.set_index('date', inplace=True)
+
+    if df.index.min().strftime('%y%m%d') != start.strftime('%y%m%d'):
+        df.loc[pd.Timestamp(start.date())] = 0
+
+    end_date = end - timedelta(days=1)
+    if df.index.max().strftime('%y%m%d') != end_date.strftime('%y%m%d'):
+        df.loc[pd.Timestamp(end_date.date())] = 0
+
+    df = df.asfreq('D', fill_value=0)
+
+    steps = list(df.steps)
+    step_goals = []
+    for i in range(7):
+        steps_nine_days = steps[i:i + 9]
+        steps_nine_days = [x for x in steps_nine_days if not pd.isna(x)]
+
+        if not steps_nine_days:
+            step_goals.append(MIN_VALUE_STEP_GOAL)
+
+        else:
+            for _ in range(9 - len(steps_nine_days)):
+                steps_nine_days.append(0)
+
+            steps_nine_days.sort()
+            step_goals.append(int(round(steps_nine_days[5], -1)))
+
+    step_goals = [min(max(x, MIN_VALUE_STEP_GOAL), MAX_VALUE_STEP_GOAL) for x in step_goals]
+
+    actual_steps = [int(x) if not np.isnan(x) else 0 for x in steps[-7:]]
+
+    goals_achieved = sum(np.array(step_goals) * PA_LAPSE_MODERATION < np.array(actual_steps))
+
+    dutch_day_abbreviations = ['Ma', 'Di', 'Wo', 'Do', 'Vr', 'Za', 'Zo']
+    dutch_date_list = [f"{dutch_day_abbreviations[day.weekday()]} {day.strftime('%d')}"
+                       for day in df.index[-7:]]
+
+    return step_goals, actual_steps, dutch_date_list, goals_achieved
+
+
+def pandas_daily_step_goal(steps_per_day: List[int]) -> int:
+    """
+    get_daily_step_goal as implemented with pandas, on the steps of the last 9 days
+    """
+    steps_per_day = list(steps_per_day)
+    for _ in range(9 - len(steps_per_day)):
+        steps_per_day.append(0)
+
+    steps_per_day.sort()
+    pa_goal = int(round(steps_per_day[5], -1))
+
+    return min(max(pa_goal, MIN_VALUE_STEP_GOAL), MAX_VALUE_STEP_GOAL)
+
+
+def make_steps_data(steps: List[int], start: datetime, missing=()) -> List[Dict[Any, Any]]:
+    return [{'date': start.date() + timedelta(days=i), 'steps': value}
+            for i, value in enumerate(steps) if i not in missing]
+
+
+def assert_same_goals(steps_data: List[Dict[Any, Any]], start: datetime, end: datetime):
+    goals, actual_steps, dates, achieved = get_step_goals_and_steps(steps_data, start, end)
+    expected = pandas_step_goals_and_steps(steps_data, start, end)
+
+    assert goals == expected[0]
+    assert actual_steps == expected[1]
+    assert dates == expected[2]
+    assert achieved == expected[3]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_histories(seed):
+    rng = np.random.default_rng(seed)
+    start = END - timedelta(days=STEP_GOALS_DAYS)
+    steps = rng.integers(0, 15000, STEP_GOALS_DAYS).tolist()
+    missing = set(rng.choice(STEP_GOALS_DAYS, rng.integers(0, 6), replace=False).tolist())
+
+    assert_same_goals(make_steps_data(steps, start, missing), start, END)
+
+
+@pytest.mark.parametrize('missing', [
+    {0},  # first day missing
+    {STEP_GOALS_DAYS - 1},  # last day missing
+    {0, STEP_GOALS_DAYS - 1},
+    set(range(3, 12)),  # a whole window missing
+    set(range(1, STEP_GOALS_DAYS - 1)),  # only the first and the last day
+    set(range(STEP_GOALS_DAYS - 1)),  # only the last day
+])
+def test_padding(missing):
+    start = END - timedelta(days=STEP_GOALS_DAYS)
+    steps = [3000 + 450 * i for i in range(STEP_GOALS_DAYS)]
+
+    assert_same_goals(make_steps_data(steps, start, missing), start, END)
+
+
+@pytest.mark.parametrize('value', [5, 15, 25, 2005, 2015, 4995, 5005, 5015, 9995, 10005])
+def test_rounding_ties(value):
+    start = END - timedelta(days=STEP_GOALS_DAYS)
+    # the 6th lowest value of each window is the tie
+    steps = [0, 0, 0, 0, 0, value, 20000, 20000, 20000] * 2
+
+    assert_same_goals(make_steps_data(steps[:STEP_GOALS_DAYS], start), start, END)
+
+    for length in range(1, STEP_GOAL_WINDOW + 1):
+        window = [value] * length
+        assert compute_step_goals(np.array(window), num_goals=1)[0] == \
+            pandas_daily_step_goal(window)
+
+
+@pytest.mark.parametrize('length', range(1, STEP_GOAL_WINDOW + 1))
+def test_short_histories(length):
+    rng = np.random.default_rng(length)
+    steps = rng.integers(0, 15000, length).tolist()
+
+    assert compute_step_goals(np.array(steps, dtype=np.float64), num_goals=1)[0] == \
+        pandas_daily_step_goal(steps)
+
+    # a new user, with data only in the last days of the range
+    start = END - timedelta(days=STEP_GOALS_DAYS)
+    steps_data = make_steps_data(steps, END - timedelta(days=length))
+    assert_same_goals(steps_data, start, END)
+
+
+@pytest.mark.parametrize('days', [STEP_GOALS_DAYS - 1, STEP_GOALS_DAYS, STEP_GOALS_DAYS + 4, 30])
+def test_truncation(days):
+    # the goals use the first 15 days of the range, the actual steps the last 7
+    rng = np.random.default_rng(days)
+    start = END - timedelta(days=days)
+    steps = rng.integers(0, 15000, days).tolist()
+
+    assert_same_goals(make_steps_data(steps, start), start, END)
+
+
+def test_cohort_matches_single_users():
+    rng = np.random.default_rng(0)
+    steps = rng.integers(0, 15000, (50, STEP_GOALS_DAYS)).astype(np.float64)
+
+    cohort = compute_step_goals(steps)
+    for user_steps, user_goals in zip(steps, cohort):
+        assert (compute_step_goals(user_steps) == user_goals).all()
+
+
+def test_no_data():
+    start = END - timedelta(days=STEP_GOALS_DAYS)
+
+    assert get_step_goals_and_steps([], start, END) == (None, None, None, None)